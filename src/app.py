@@ -1,9 +1,14 @@
 import streamlit as st
 
-from etl.ingest import import_files
+from utils.persistence import load_config
+from utils.startup import start_warm_up
 
 st.set_page_config(page_title="ETL Application", layout="wide")
 
+# Import pipeline + đọc trước rule / tham chiếu ở nền (nếu bật), 1 lần mỗi process,
+# bắt đầu từ lần mở trang đầu tiên (Streamlit chỉ chạy app.py khi có session)
+start_warm_up(load_config())
+
 xuat_sach = st.Page("ui/xuatsach.py", title="Báo cáo Xuất sạch")
 
 
@@ -0,0 +1,226 @@
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional
+
+import polars as pl
+
+from etl.ingest import FileInput, file_name, file_size
+from utils.cache import file_stamp
+from utils.persistence import get_config_path
+
+MANIFEST_FILE = "manifest.json"
+BASE_FILE = "base.parquet"
+INPUTS_DIR = "inputs"
+LOCK_FILE = "run.lock"
+RUN_ID_PATTERN = re.compile(r"[0-9a-f]{16}(-\d+)?(\.deleting-\d+-\d+)?")
+RUN_MAX_AGE_DAYS = 7  # Checkpoint của lần chạy bị bỏ dở lâu hơn thì tự xóa
+
+# Thư mục checkpoint đang được các lần chạy trong process này giữ lock
+_held_runs: set[str] = set()
+_runs_lock = threading.RLock()
+
+
+# ---- run directory -------------------------------------------
+def run_id(input_files: Iterable[FileInput]) -> str:
+    """
+    Id lần chạy theo tên các file raw (không theo dung lượng): sửa lại 1 file rồi chạy tiếp
+    vẫn dùng chung thư mục, các file không đổi được lấy lại từ checkpoint
+    """
+    keys = sorted(file_name(f) for f in input_files)
+    return hashlib.sha1("\n".join(keys).encode("utf-8")).hexdigest()[:16]
+
+
+def inputs_key(input_files: Iterable[FileInput]) -> list[str]:
+    """Dấu vết bộ file raw (tên + dung lượng), đổi file nào thì base phải chuẩn bị lại"""
+    return sorted(f"{file_name(f)}:{file_size(f)}" for f in input_files)
+
+
+def _lock_path(run_dir: str) -> str:
+    return os.path.join(run_dir, LOCK_FILE)
+
+
+def is_locked(run_dir: str) -> bool:
+    """
+    Thư mục đang được 1 lần chạy khác dùng.
+    Lock của process này chỉ còn hiệu lực khi lần chạy vẫn đang giữ (_held_runs);
+    lock của process khác coi là còn hiệu lực tới khi quá RUN_MAX_AGE_DAYS ngày.
+    """
+    try:
+        with open(_lock_path(run_dir), "r", encoding="utf-8") as f:
+            owner = json.load(f)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError):
+        return True  # Lock đang được ghi
+
+    if owner.get("pid") == os.getpid():
+        with _runs_lock:
+            return run_dir in _held_runs
+    return time.time() - owner.get("time", 0) < RUN_MAX_AGE_DAYS * 24 * 3600
+
+
+def _try_lock(run_dir: str) -> bool:
+    # Giữ _runs_lock: các session trong process không cùng lúc gỡ / tạo lock của 1 thư mục
+    with _runs_lock:
+        os.makedirs(run_dir, exist_ok=True)
+        if os.path.exists(_lock_path(run_dir)) and not is_locked(run_dir):
+            # Lock bỏ lại của lần chạy đã dừng
+            os.remove(_lock_path(run_dir))
+
+        try:
+            fd = os.open(_lock_path(run_dir), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"pid": os.getpid(), "time": time.time()}, f)
+
+        _held_runs.add(run_dir)
+        return True
+
+
+def remove_stale_runs(root: str) -> None:
+    """Xóa thư mục checkpoint của các lần chạy bị bỏ dở quá RUN_MAX_AGE_DAYS ngày"""
+    cutoff = time.time() - RUN_MAX_AGE_DAYS * 24 * 3600
+    for entry in os.scandir(root):
+        # Chỉ xóa thư mục có dạng run_id (checkpoint_folder có thể chứa thư mục khác)
+        if not entry.is_dir() or not RUN_ID_PATTERN.fullmatch(entry.name):
+            continue
+        if entry.stat().st_mtime < cutoff and not is_locked(entry.path):
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+@contextmanager
+def open_run_dir(input_files: list, config: Dict) -> Iterator[Optional[str]]:
+    """
+    Thư mục checkpoint của lần chạy (None nếu không bật checkpoint), giữ lock trong suốt khối with.
+    Cùng bộ tên file có thể được nhiều session chạy cùng lúc: thư mục đang bị khóa thì dùng
+    thư mục kế tiếp (<run_id>-2, -3, ...), lần chạy này không đụng tới checkpoint của lần khác.
+    """
+    options = config["pipeline_options"]
+    if options.get("checkpoint") != "True":
+        yield None
+        return
+
+    root = options.get("checkpoint_folder") or str(get_config_path().parent / "runs")
+    os.makedirs(root, exist_ok=True)
+    remove_stale_runs(root)
+
+    base_id = run_id(input_files)
+    run_dir = None
+    for attempt in itertools.count(1):
+        candidate = os.path.join(root, base_id if attempt == 1 else f"{base_id}-{attempt}")
+        try:
+            if _try_lock(candidate):
+                run_dir = candidate
+                break
+        except FileNotFoundError:
+            # Thư mục vừa bị lần chạy sở hữu nó xóa: thử lại lượt sau
+            continue
+
+    try:
+        yield run_dir
+    finally:
+        with _runs_lock:
+            _held_runs.discard(run_dir)
+        try:
+            os.remove(_lock_path(run_dir))
+        except FileNotFoundError:
+            pass  # Đã clear_run
+
+
+def inputs_dir(run_dir: Optional[str]) -> Optional[str]:
+    return os.path.join(run_dir, INPUTS_DIR) if run_dir else None
+
+
+def clear_run(run_dir: Optional[str]) -> None:
+    """Xóa checkpoint sau khi chạy xong toàn bộ"""
+    if run_dir:
+        # Đổi tên trước khi xóa: session khác không thể khóa lại thư mục đang bị xóa dở
+        trash = f"{run_dir}.deleting-{os.getpid()}-{threading.get_ident()}"
+        os.rename(run_dir, trash)
+        shutil.rmtree(trash, ignore_errors=True)
+
+
+def files_stamp(paths: Iterable[Optional[str]]) -> list:
+    """Dấu vết (đường dẫn, mtime, dung lượng) của các file tham chiếu / rule, dạng lưu được json"""
+    return [list(stamp) if stamp else None for stamp in map(file_stamp, paths)]
+
+
+# ---- manifest ------------------------------------------------
+def load_manifest(run_dir: str) -> Dict:
+    path = os.path.join(run_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {"base": None, "outputs": {}, "export_suffix": None}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(run_dir: str, manifest: Dict) -> None:
+    path = os.path.join(run_dir, MANIFEST_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+# ---- stages --------------------------------------------------
+def load_base(run_dir: str, stamp: list) -> Optional[tuple[pl.DataFrame, str, int]]:
+    """Base đã chuẩn bị ở lần chạy trước (nếu file tham chiếu không đổi)"""
+    meta = load_manifest(run_dir)["base"]
+    path = os.path.join(run_dir, BASE_FILE)
+
+    if meta is None or meta["stamp"] != stamp or not os.path.exists(path):
+        return None
+    return pl.read_parquet(path), meta["date"], meta["rows_in"]
+
+
+def save_base(run_dir: str, df: pl.DataFrame, date: str, rows_in: int, stamp: list) -> None:
+    path = os.path.join(run_dir, BASE_FILE)
+    tmp_path = f"{path}.tmp"
+    df.write_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+    # Base mới → các output đã ghi từ base cũ không còn đúng
+    manifest = {
+        "base": {"date": date, "rows_in": rows_in, "stamp": stamp},
+        "outputs": {},
+        "export_suffix": None,
+    }
+    save_manifest(run_dir, manifest)
+
+
+def run_export_suffix(run_dir: str, export_suffix: str) -> str:
+    """
+    Hậu tố tên file output của lần chạy: lấy lại từ lần chạy trước nếu có
+    (hậu tố theo giờ chạy sẽ khác nhau giữa các lần, output đã ghi không được nhận lại)
+    """
+    manifest = load_manifest(run_dir)
+    if manifest.get("export_suffix"):
+        return manifest["export_suffix"]
+
+    manifest["export_suffix"] = export_suffix
+    save_manifest(run_dir, manifest)
+    return export_suffix
+
+
+def done_output_paths(run_dir: str, name: str, stamp: list) -> Optional[list[str]]:
+    """File của output đã ghi xong ở lần chạy trước (cùng rule, cùng đích ghi), None nếu cần ghi lại"""
+    done = load_manifest(run_dir)["outputs"].get(name)
+    if done is None or done["stamp"] != stamp:
+        return None
+    if not all(os.path.exists(p) for p in done["paths"]):
+        return None
+    return done["paths"]
+
+
+def mark_output_done(run_dir: str, name: str, stamp: list, paths: list[str]) -> None:
+    manifest = load_manifest(run_dir)
+    manifest["outputs"][name] = {"stamp": stamp, "paths": paths}
+    save_manifest(run_dir, manifest)
@@ -0,0 +1,127 @@
+import inspect
+from dataclasses import dataclass
+from typing import Union
+
+import polars as pl
+
+from etl.ingest import FileInput, estimate_file_memory
+
+DEFAULT_KEYS = ["ma_phieugui", "ma_tai"]
+
+# Cột giải thích lý do thay đổi (nếu có trong kết quả)
+DETAIL_COLS = [
+    "Result_p",
+    "deadline",
+    "thoigian_nhapdau",
+    "thoigian_nhapcuoi",
+    "thoigian_xuat",
+    "ngay_xuat",
+    "timedelta",
+]
+
+MISSING = "Không có"
+
+# Bản polars mới đổi tên join_nulls thành nulls_equal
+NULLS_EQUAL_ARG = (
+    "nulls_equal"
+    if "nulls_equal" in inspect.signature(pl.LazyFrame.join).parameters
+    else "join_nulls"
+)
+
+
+@dataclass(frozen=True)
+class CompareResult:
+    changed: pl.DataFrame
+    transitions: pl.DataFrame
+    # Key bị trùng trong từng bên (chỉ giữ dòng đầu khi so sánh)
+    duplicates: pl.DataFrame
+
+
+def scan_result(file: FileInput) -> pl.LazyFrame:
+    """
+    Đọc file kết quả đã lưu (csv) dạng scan, giữ các cột dạng chuỗi để không phải suy kiểu.
+    File upload cũng scan được (IO[bytes]) nên chỉ các cột key / DETAIL_COLS được parse.
+    """
+    if hasattr(file, "seek"):
+        file.seek(0)  # pyright: ignore[reportAttributeAccessIssue]
+    return pl.scan_csv(file, infer_schema=False)  # pyright: ignore[reportArgumentType]
+
+
+def estimate_memory(files: list[FileInput]) -> int:
+    """RAM ước lượng khi so sánh các file kết quả đã lưu"""
+    return sum(estimate_file_memory(f) for f in files)
+
+
+def _side(lf: pl.LazyFrame, keys: list[str], suffix: str) -> pl.LazyFrame:
+    names = lf.collect_schema().names()
+    cols = [c for c in DETAIL_COLS if c in names]
+
+    return lf.select(
+        [pl.col(k).cast(pl.String) for k in keys]
+        + [pl.col(c).cast(pl.String).alias(f"{c}{suffix}") for c in cols]
+    )
+
+
+def _unique_keys(lf: pl.LazyFrame, keys: list[str]) -> pl.LazyFrame:
+    # Key trùng sẽ nhân dòng khi join, chỉ giữ dòng đầu tiên
+    return lf.unique(subset=keys, keep="first", maintain_order=True)
+
+
+def _duplicate_keys(lf: pl.LazyFrame, keys: list[str], side: str) -> pl.LazyFrame:
+    return (
+        lf.group_by(keys)
+        .agg(pl.len().cast(pl.UInt32).alias("so_dong"))
+        .filter(pl.col("so_dong") > 1)
+        .select(pl.lit(side).alias("ben"), *keys, "so_dong")
+    )
+
+
+def compare_results(
+    old: Union[pl.LazyFrame, pl.DataFrame],
+    new: Union[pl.LazyFrame, pl.DataFrame],
+    keys: list[str] = DEFAULT_KEYS,
+) -> CompareResult:
+    """
+    So sánh 2 bộ kết quả theo key (mặc định ma_phieugui, ma_tai).
+    - changed: các dòng có Result_p khác nhau, kèm deadline / rule cũ và mới
+    - transitions: ma trận số dòng Result_p cũ (dòng) → Result_p mới (cột)
+    - duplicates: các key bị trùng ở từng bên, chỉ dòng đầu tiên được đem so sánh
+    Dòng chỉ có ở 1 bên được tính là "Không có" ở bên còn lại; key null được so khớp với nhau.
+    """
+    old_side = _side(old.lazy(), keys, "_cu")
+    new_side = _side(new.lazy(), keys, "_moi")
+
+    joined = _unique_keys(old_side, keys).join(
+        _unique_keys(new_side, keys),
+        on=keys,
+        how="full",
+        coalesce=True,
+        **{NULLS_EQUAL_ARG: True},
+    )
+    joined = joined.with_columns(
+        pl.col("Result_p_cu").fill_null(MISSING),
+        pl.col("Result_p_moi").fill_null(MISSING),
+    )
+
+    changed, counts, duplicates = pl.collect_all(
+        [
+            joined.filter(pl.col("Result_p_cu") != pl.col("Result_p_moi")),
+            joined.group_by(["Result_p_cu", "Result_p_moi"]).agg(pl.len().alias("so_dong")),
+            pl.concat(
+                [
+                    _duplicate_keys(old_side, keys, "cũ"),
+                    _duplicate_keys(new_side, keys, "mới"),
+                ]
+            ),
+        ]
+    )
+
+    transitions = (
+        counts.sort("Result_p_moi")
+        .pivot(on="Result_p_moi", index="Result_p_cu", values="so_dong")
+        .fill_null(0)
+        .sort("Result_p_cu")
+    )
+
+    return CompareResult(changed=changed, transitions=transitions, duplicates=duplicates)
+
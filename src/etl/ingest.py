@@ -1,15 +1,24 @@
+import os
 import re
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Iterable, Union
+from typing import Dict, Iterable, Iterator, Optional, Union
 
+import fastexcel
 import polars as pl
 
+from etl.xlsx_head import read_xlsx_head
+
 MAX_WORKERS = 6
 SUPPORTED_EXTENSIONS = {".csv", ".xlsx"}
 DATE_PATTERN = re.compile(r"(\d{4}_\d{2}_\d{2})__\d+")
+XLSX_HEADER_ROW = 1  # File từ NOC có 2 dòng header bị merge, tên cột nằm ở dòng thứ 2
+
+# RAM ước lượng khi đọc hết 1 file vào bộ nhớ ~ MEMORY_FACTORS[ext] lần dung lượng file
+# (xlsx là file nén, giải nén + giải mã tốn hơn csv nhiều)
+MEMORY_FACTORS = {".csv": 4, ".xlsx": 25}
 
 
 @dataclass(frozen=True)
@@ -18,6 +27,13 @@ class ImportResult:
     date: str
 
 
+@dataclass(frozen=True)
+class BatchInput:
+    lf: pl.LazyFrame
+    date: str
+    streamed: bool  # True: đọc dạng scan (csv), False: đã đọc hết vào bộ nhớ (xlsx)
+
+
 FileInput = Union[str, Path, object]
 
 
@@ -30,6 +46,68 @@ def file_ext(file: FileInput) -> str:
     return Path(file_name(file)).suffix.lower()
 
 
+def file_size(file: FileInput) -> int:
+    if hasattr(file, "size"):
+        return file.size  # pyright: ignore[reportAttributeAccessIssue]
+    return os.path.getsize(file)  # pyright: ignore[reportArgumentType]
+
+
+def check_extension(files: list[FileInput]) -> str:
+    extensions = {file_ext(f) for f in files}
+
+    if len(extensions) != 1:
+        raise ValueError("Mixed or unsupported file extensions detected.")
+
+    ext = extensions.pop()
+    if ext not in SUPPORTED_EXTENSIONS:
+        raise ValueError("Unsupported file extension detected.")
+
+    return ext
+
+
+def estimate_file_memory(file: FileInput) -> int:
+    """RAM ước lượng (bytes) khi đọc hết file vào bộ nhớ"""
+    return file_size(file) * MEMORY_FACTORS.get(file_ext(file), max(MEMORY_FACTORS.values()))
+
+
+def group_by_date(files: list[FileInput]) -> dict[str, list[FileInput]]:
+    by_date: dict[str, list[FileInput]] = {}
+    for file in files:
+        by_date.setdefault(extract_date([file]), []).append(file)
+    return by_date
+
+
+def batch_files(files: list[FileInput], max_bytes: int) -> list[list[FileInput]]:
+    """
+    Gom file theo ngày báo cáo, mỗi batch tổng RAM ước lượng tối đa max_bytes.
+    File vượt max_bytes được xử lý riêng 1 batch (xem oversized_files).
+    """
+    batches: list[list[FileInput]] = []
+    for date_files in group_by_date(files).values():
+        batch: list[FileInput] = []
+        batch_size = 0
+        for file in date_files:
+            size = estimate_file_memory(file)
+            if batch and batch_size + size > max_bytes:
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append(file)
+            batch_size += size
+        if batch:
+            batches.append(batch)
+
+    return batches
+
+
+def oversized_files(files: list[FileInput], max_bytes: int) -> list[str]:
+    """File phải đọc hết vào bộ nhớ (xlsx) mà RAM ước lượng vượt max_bytes"""
+    return [
+        file_name(f)
+        for f in files
+        if file_ext(f) == ".xlsx" and estimate_file_memory(f) > max_bytes
+    ]
+
+
 def extract_date(files: Iterable[FileInput]) -> str:
     """Nhận dạng ngày từ tên file báo cáo"""
     dates = set()
@@ -51,6 +129,86 @@ def extract_date(files: Iterable[FileInput]) -> str:
 
 
 # ---- loaders -------------------------------------------------
+def checkpoint_stem(file: FileInput) -> str:
+    return re.sub(r"[^\w.-]", "_", file_name(file))
+
+
+def checkpoint_path(checkpoint_dir: str, file: FileInput) -> str:
+    """File parquet lưu kết quả đọc của 1 file raw (theo tên + dung lượng)"""
+    return os.path.join(checkpoint_dir, f"{checkpoint_stem(file)}_{file_size(file)}.parquet")
+
+
+def remove_stale_checkpoints(checkpoint_dir: str, file: FileInput) -> None:
+    """Xóa checkpoint của phiên bản cũ (khác dung lượng) của cùng 1 file raw"""
+    pattern = re.compile(rf"{re.escape(checkpoint_stem(file))}_\d+\.parquet")
+    for name in os.listdir(checkpoint_dir):
+        if pattern.fullmatch(name):
+            os.remove(os.path.join(checkpoint_dir, name))
+
+
+def read_file(
+    file: FileInput,
+    reader,
+    checkpoint_dir: Optional[str] = None,
+    **opts,
+) -> pl.DataFrame:
+    # Đã đọc xong ở lần chạy trước → lấy lại từ checkpoint
+    if checkpoint_dir is not None:
+        path = checkpoint_path(checkpoint_dir, file)
+        if os.path.exists(path):
+            return pl.read_parquet(path)
+
+    # File upload có thể đã được đọc ở lần chạy trước (preview, chạy lại)
+    if hasattr(file, "seek"):
+        file.seek(0)  # pyright: ignore[reportAttributeAccessIssue]
+    df = reader(file, **opts)
+
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        remove_stale_checkpoints(checkpoint_dir, file)
+        tmp_path = f"{path}.tmp"
+        df.write_parquet(tmp_path)
+        os.replace(tmp_path, path)
+
+    return df
+
+
+def read_xlsx(
+    file: FileInput,
+    columns: Optional[list[str]] = None,
+    schema_overrides: Optional[Dict[str, pl.DataType]] = None,
+    n_rows: Optional[int] = None,
+    max_workers: int = MAX_WORKERS,
+) -> pl.DataFrame:
+    """
+    Đọc file XLSX từ NOC: chỉ đọc các cột cần, kiểu dữ liệu khai báo sẵn (không suy kiểu),
+    header lấy trực tiếp ở dòng XLSX_HEADER_ROW. Workbook nhiều sheet được đọc song song.
+    Có n_rows thì chỉ đọc phần đầu file (xem read_xlsx_head).
+    """
+    source = file.getvalue() if hasattr(file, "getvalue") else file  # pyright: ignore[reportAttributeAccessIssue]
+    if n_rows is not None:
+        return read_xlsx_head(source, n_rows, XLSX_HEADER_ROW, columns, schema_overrides)
+
+    sheet_names = fastexcel.read_excel(source).sheet_names  # pyright: ignore[reportArgumentType]
+
+    def read_sheet(sheet_name: str) -> pl.DataFrame:
+        return pl.read_excel(
+            source,  # pyright: ignore[reportArgumentType]
+            sheet_name=sheet_name,
+            columns=columns,
+            schema_overrides=schema_overrides,
+            read_options={"header_row": XLSX_HEADER_ROW, "n_rows": n_rows},
+        )
+
+    if len(sheet_names) == 1:
+        return read_sheet(sheet_names[0])
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(sheet_names))) as executor:
+        dfs = list(executor.map(read_sheet, sheet_names))
+
+    return pl.concat(dfs, rechunk=True)
+
+
 def load_threaded(
     files: Iterable[FileInput],
     reader,
@@ -58,16 +216,22 @@ def load_threaded(
     **opts,
 ) -> pl.DataFrame:
     dfs: list[pl.DataFrame] = []
+    errors: list[tuple[FileInput, Exception]] = []
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(reader, f, **opts): f for f in files}
+        futures = {executor.submit(read_file, f, reader, **opts): f for f in files}
 
+        # Đọc hết các file còn lại trước khi báo lỗi để checkpoint giữ được phần đã đọc
         for future in as_completed(futures):
             file = futures[future]
             try:
                 dfs.append(future.result())
             except Exception as exc:
-                raise RuntimeError(f"Failed to read file: {file_name(file)}") from exc
+                errors.append((file, exc))
+
+    if errors:
+        names = ", ".join(file_name(file) for file, _ in errors)
+        raise RuntimeError(f"Failed to read file: {names}") from errors[0][1]
 
     return pl.concat(dfs, rechunk=True)
 
@@ -81,7 +245,7 @@ def load_files(
     if use_threads == "True":
         return load_threaded(files, reader, **opts)
 
-    dfs = [reader(f, **opts) for f in files]
+    dfs = [read_file(f, reader, **opts) for f in files]
     return pl.concat(dfs, rechunk=True)
 
 
@@ -89,17 +253,18 @@ def load_files(
 def import_files(
     files: Iterable[FileInput],
     fast_mode: str = "False",
+    n_rows: Optional[int] = None,
+    columns: Optional[list[str]] = None,
+    schema_overrides: Optional[Dict[str, pl.DataType]] = None,
+    checkpoint_dir: Optional[str] = None,
 ) -> ImportResult:
+    """
+    n_rows: chỉ đọc n dòng đầu mỗi file (dùng cho xem trước)
+    columns / schema_overrides: chỉ đọc các cột cần với kiểu khai báo sẵn
+    checkpoint_dir: lưu / lấy lại kết quả đọc từng file (chạy lại sau lỗi)
+    """
     files = list(files)
-    extensions = {file_ext(f) for f in files}
-
-    if len(extensions) != 1:
-        raise ValueError("Mixed or unsupported file extensions detected.")
-
-    ext = extensions.pop()
-    if ext not in SUPPORTED_EXTENSIONS:
-        raise ValueError("Unsupported file extension detected.")
-
+    ext = check_extension(files)
     date = extract_date(files)
 
     if ext == ".csv":
@@ -107,16 +272,71 @@ def import_files(
             files,
             reader=pl.read_csv,
             use_threads=fast_mode,
+            n_rows=n_rows,
+            columns=columns,
+            schema_overrides=schema_overrides,
+            checkpoint_dir=checkpoint_dir,
         )
     else:  # .xlsx
         df = load_files(
             files,
-            reader=pl.read_excel,
+            reader=read_xlsx,
             use_threads=fast_mode,
-            read_options={"skip_rows": 1},  # Đọc file từ NOC có 2 dòng header bị merge
+            n_rows=n_rows,
+            columns=columns,
+            schema_overrides=schema_overrides,
+            checkpoint_dir=checkpoint_dir,
         )
 
     return ImportResult(
         df=df,
         date=date,
     )
+
+
+def scan_csv_files(
+    files: list[FileInput],
+    columns: Optional[list[str]] = None,
+    schema_overrides: Optional[Dict[str, pl.DataType]] = None,
+) -> pl.LazyFrame:
+    """Scan (không đọc hết) các file csv, chỉ lấy các cột cần"""
+    lfs = []
+    for file in files:
+        if hasattr(file, "seek"):
+            file.seek(0)  # pyright: ignore[reportAttributeAccessIssue]
+        lf = pl.scan_csv(file, schema_overrides=schema_overrides)  # pyright: ignore[reportArgumentType]
+        lfs.append(lf.select(columns) if columns else lf)
+    return pl.concat(lfs)
+
+
+def iter_import_batches(
+    files: Iterable[FileInput],
+    fast_mode: str = "False",
+    max_bytes: int = 512 * 1024 * 1024,
+    columns: Optional[list[str]] = None,
+    schema_overrides: Optional[Dict[str, pl.DataType]] = None,
+    checkpoint_dir: Optional[str] = None,
+) -> Iterator[BatchInput]:
+    """
+    Đọc lần lượt từng batch thay vì đọc hết 1 lần:
+    - csv: mỗi ngày 1 batch dạng scan, chạy bằng streaming engine nên không phụ thuộc dung lượng
+    - xlsx: phải đọc hết từng file, gom theo ngày với RAM ước lượng tối đa max_bytes / batch
+    """
+    files = list(files)
+    ext = check_extension(files)
+
+    if ext == ".csv":
+        for date_files in group_by_date(files).values():
+            lf = scan_csv_files(date_files, columns, schema_overrides)
+            yield BatchInput(lf=lf, date=extract_date(date_files), streamed=True)
+        return
+
+    for batch in batch_files(files, max_bytes):
+        result = import_files(
+            batch,
+            fast_mode,
+            columns=columns,
+            schema_overrides=schema_overrides,
+            checkpoint_dir=checkpoint_dir,
+        )
+        yield BatchInput(lf=result.df.lazy(), date=result.date, streamed=False)
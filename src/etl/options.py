@@ -0,0 +1,17 @@
+"""Pipeline options shared with the UI; kept free of polars so pages load without it."""
+
+# Output: (mục config, key folder rule, key file rule)
+RULE_LOCATIONS = {
+    "RD": ("xuat_sach_hub", "rule_rd_folder", "rule_rd_file"),
+    "KN": ("xuat_sach_hub", "rule_kn_folder", "rule_kn_file"),
+    "TTKT": ("xuat_sach_ttkt", "rule_folder", "rule_file"),
+}
+
+SELECT_OUTPUTS = {
+    "hub": ["RD", "KN"],
+    "ttkt": ["TTKT"],
+    "all": ["RD", "KN", "TTKT"],
+}
+
+# Cột có thể dùng để tách file output theo nhánh
+PARTITION_COLUMNS = ["chi_nhanh_HUB", "don_vi_khaithac"]
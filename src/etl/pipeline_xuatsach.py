@@ -1,11 +1,39 @@
 import os
-from dataclasses import dataclass
+import re
+from dataclasses import dataclass, replace
 import time
 import polars as pl
 from io import BytesIO
-from typing import Dict
-
-from etl.ingest import import_files
+from typing import Dict, Optional, Union
+
+from etl.checkpoint import (
+    clear_run,
+    done_output_paths,
+    files_stamp,
+    inputs_dir,
+    inputs_key,
+    load_base,
+    mark_output_done,
+    open_run_dir,
+    run_export_suffix,
+    save_base,
+)
+from etl.ingest import (
+    estimate_file_memory,
+    extract_date,
+    file_name,
+    import_files,
+    iter_import_batches,
+    oversized_files,
+)
+from etl.options import RULE_LOCATIONS, SELECT_OUTPUTS
+from etl.reference import (
+    ReferenceDimensions,
+    load_reference,
+    with_branch_lookup,
+    with_chi_nhanh_hub,
+)
+from utils.cache import load_shared
 
 @dataclass(frozen=True)
 class PipelineResult:
@@ -13,13 +41,18 @@ class PipelineResult:
     rows_out: int
     output_files: list[str]
 
-# --- Config ---
 
-HUB_OVERRIDES = {
-    # don_vi_khai_thac: chi_nhanh_HUB
-    "HUBTAN": "BDG",
-    "HUBBHD": "BDH",
-}
+@dataclass(frozen=True)
+class PreparedInput:
+    # Base đã chuẩn bị (đã ép kiểu, join lookup), dùng lại khi chỉ đổi rule
+    df: pl.DataFrame
+    date: str
+    rows_in: int
+    source_files: tuple[str, ...]  # Tên các file raw đã dùng
+    # Plan đầy đủ từ dữ liệu vừa đọc (chỉ có khi bật profiling, không giữ qua các lần chạy)
+    plan: Optional[pl.LazyFrame] = None
+
+# --- Config ---
 
 RULE_SCHEMA_OVERRIDES = {
     "thoigian_nhapdau": pl.Time(),
@@ -74,34 +107,67 @@ COLS_XUAT_SACH_TTKT = [
 #     "timedelta"
 ]
 
+HUB_FILE_NAMES = {"RD": "RaiDich", "KN": "KetNoi"}
+
+TTKT_CSV_OPTIONS = {
+    "datetime_format": "%Y-%m-%d %H:%M:%S",
+    "date_format": "%Y-%m-%d",
+    "time_format": "%H:%M:%S",
+}
+
+RULE_TYPES = {"RD": "RD", "KN": "KN", "TTKT": "RD"}  # Rule TTKT tương tự rule Rải đích
+
+RULE_JOIN_KEYS = {
+    "RD": {
+        "left_on": ["don_vi_khaithac", "ma_buucuc_phat"],
+        "right_on": ["don_vi_khai_thac", "buu_cuc_phat"],
+    },
+    "KN": {
+        "left_on": ["don_vi_khaithac", "chi_nhanh_phat"],
+        "right_on": ["don_vi_khai_thac", "chi_nhanh_phat"],
+    },
+}
+
+# Tách file output theo nhánh (thư mục con theo giá trị cột)
+PARTITION_NULL_LABEL = "_khong_xac_dinh"
+PARTITION_UNSAFE_CHARS = re.compile(r'[\\/:*?"<>|]')
+
+# LazyFrame.profile bị bỏ ở polars 2.0 → đo theo từng bước (profile_stages)
+PROFILE_SUPPORTED = hasattr(pl.LazyFrame, "profile")
+
+# Preview: chế độ ngẫu nhiên lấy mẫu từ PREVIEW_POOL_FACTOR * n dòng đầu mỗi file
+PREVIEW_POOL_FACTOR = 10
+
+# Out-of-core: giới hạn RAM mặc định (MB)
+DEFAULT_MEMORY_CAP_MB = 4096
+# RAM khi đọc lại parquet tạm của 1 batch ~ PARQUET_MEMORY_FACTOR lần dung lượng file
+PARQUET_MEMORY_FACTOR = 8
+
+# Cột đọc từ file raw (hợp của các pipeline), khai báo sẵn kiểu chuỗi để không phải suy kiểu.
+# Cột thời gian ép kiểu datetime ở prepare_base.
+INPUT_COLUMNS = list(dict.fromkeys(COLS_XUAT_SACH_HUB + COLS_XUAT_SACH_TTKT))
+INPUT_SCHEMA_OVERRIDES = {col: pl.String() for col in INPUT_COLUMNS}
+
+# Cột key của rule, ép kiểu chuỗi cho khớp kiểu với file raw
+RULE_KEY_COLS = ["don_vi_khai_thac", "buu_cuc_phat", "chi_nhanh_phat"]
+
 # --- Helper functions ---
 
 def import_rule(file_path: str, rule_type: str) -> pl.DataFrame:
     df = pl.read_excel(file_path, schema_overrides=RULE_SCHEMA_OVERRIDES)
-    # Pending validation logic
-    return df
-    
-
-def import_lookup(file_path: str) -> pl.DataFrame:
-    df = pl.read_excel(file_path)
+    df = df.with_columns([pl.col(c).cast(pl.String) for c in RULE_KEY_COLS if c in df.columns])
     # Pending validation logic
     return df
     
 
 def apply_rule(lf: pl.LazyFrame, rule: pl.LazyFrame, type: str) -> pl.LazyFrame:
-    # Join keys
-    join_keys_mapping = {
-        "RD": {
-            "left_on": ["don_vi_khaithac", "ma_buucuc_phat"],
-            "right_on": ["don_vi_khai_thac", "buu_cuc_phat"],
-        },
-        "KN": {
-            "left_on": ["don_vi_khaithac", "chi_nhanh_phat"],
-            "right_on": ["don_vi_khai_thac", "chi_nhanh_phat"],
-        },
-    }
+    return label_result(match_rule(lf, rule, type))
+
 
-    keys = join_keys_mapping[type]
+def match_rule(lf: pl.LazyFrame, rule: pl.LazyFrame, type: str) -> pl.LazyFrame:
+    """Join rule, tìm khung giờ nhập phù hợp và deadline của mỗi đơn"""
+    # Join keys
+    keys = RULE_JOIN_KEYS[type]
 
     # Join
     lf = lf.join(
@@ -143,15 +209,19 @@ def apply_rule(lf: pl.LazyFrame, rule: pl.LazyFrame, type: str) -> pl.LazyFrame:
         .alias("deadline")
     )
 
+    return lf.filter(
+        (~pl.col("_key_matched"))
+        | (pl.col("_key_matched") & pl.col("_time_matched"))
+    )
+
+
+def label_result(lf: pl.LazyFrame) -> pl.LazyFrame:
     # Gán nhãn:
     # - Nếu không tìm thấy cặp key thì rule đang thiếu → Check lại
     # - Nếu thấy cặp key, nhưng không có khung thời gian nào hợp lệ → Thiếu config
     # - Nếu thời gian lái xe nhận (thời gian xuất kho) <= deadline → Đúng
     # - Còn lại là sai hẹn
-    lf = lf.filter(
-        (~pl.col("_key_matched"))
-        | (pl.col("_key_matched") & pl.col("_time_matched"))
-    ).with_columns(
+    lf = lf.with_columns(
         pl.when(pl.col("_key_matched").not_())
         .then(pl.lit("Check lại"))
         .when(pl.col("_time_matched").not_())
@@ -170,89 +240,96 @@ def apply_rule(lf: pl.LazyFrame, rule: pl.LazyFrame, type: str) -> pl.LazyFrame:
     return lf
 
 
-def pipeline_xs_hub(
-    input_files: list,
-    config: Dict
-) -> Dict:
-    """
-    Pipeline Xuất sạch HUB
-    "common": {
-        "thamchieu_noitinh": null
-    },
-    "xuat_sach_hub": {
-        "rule_rd_folder": null,
-        "rule_rd_file": null,
-        "rule_kn_folder": null,
-        "rule_kn_file": null,
-        "output_rd_folder": "output",
-        "output_kn_folder": "output"
-    },
-    "pipeline_options": {
-        "pipeline_select": null,
-        "fast_mode": false
-    }
-    """
-    # Load options
-    lookup_path = config["common"]["thamchieu_noitinh"]
-    opts = config["xuat_sach_hub"]
+def add_timedelta(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Thêm cột timedelta (d.hh:mm:ss) cho các đơn Sai hẹn"""
+    lf = lf.with_columns(
+        pl.when(pl.col("Result_p") == "Sai hẹn").then((pl.col("tg_laixe_nhan") - pl.col("deadline"))).alias("_time_delta")
+    )
+
+    lf = lf.with_columns([
+        (pl.col("_time_delta").abs().dt.total_seconds() // (24 * 60 * 60)).alias("days"),  # Calculate days
+        (pl.col("_time_delta").abs().dt.total_seconds() // 3600 % 24).alias("hours"),   # Calculate hours
+        (pl.col("_time_delta").abs().dt.total_seconds() // 60 % 60).alias("minutes"),    # Calculate minutes
+        (pl.col("_time_delta").abs().dt.total_seconds() % 60).alias("seconds")
+    ])
+
+    lf = lf.with_columns(
+        pl.concat_str([
+            pl.col("days").cast(pl.Utf8),
+            pl.lit("."),
+            pl.col("hours").cast(pl.Utf8).str.zfill(2),
+            pl.lit(":"),
+            pl.col("minutes").cast(pl.Utf8).str.zfill(2),
+            pl.lit(":"),
+            pl.col("seconds").cast(pl.Utf8).str.zfill(2),
+        ]).alias("timedelta")
+    )
+
+    # Cleanup sau khi thêm timedelta
+    return lf.drop(["days", "hours", "minutes","seconds", "_time_delta"])
+
+
+def estimate_memory(input_files: list, config: Dict) -> int:
+    """RAM ước lượng (bytes) của 1 lượt chạy, dùng cho hàng đợi chạy chung"""
+    estimate = sum(estimate_file_memory(f) for f in input_files)
+
     pipeline_cfg = config["pipeline_options"]
+    if pipeline_cfg.get("out_of_core") == "True":
+        memory_cap_mb = int(pipeline_cfg.get("memory_cap_mb") or DEFAULT_MEMORY_CAP_MB)
+        estimate = min(estimate, memory_cap_mb * 1024 * 1024)
 
-    # Load rules & lookup
-    rule_rd_path = os.path.join(opts["rule_rd_folder"], opts["rule_rd_file"])
-    lf_rule_rd = import_rule(rule_rd_path, "RD").lazy()
+    return estimate
 
-    rule_kn_path = os.path.join(opts["rule_kn_folder"], opts["rule_kn_file"])
-    lf_rule_kn = import_rule(rule_kn_path, "KN").lazy()
 
-    lf_lookup = import_lookup(lookup_path).lazy()
+def get_export_suffix(date: str) -> str:
+    if date == "":
+        return time.strftime("%Y%m%d_%H%M%S")
+    return date
 
-    # Ingest raw
-    import_result = import_files(input_files, pipeline_cfg["fast_mode"])
-    df = import_result.df
-    rows_in = df.height
 
+# --- Stages ---
+
+def prepare_base(
+    df: Union[pl.DataFrame, pl.LazyFrame],
+    date: str,
+    ref: ReferenceDimensions,
+    columns: list[str],
+) -> pl.LazyFrame:
+    """
+    Phần chuẩn bị dùng chung cho HUB và TTKT:
+    chọn cột, ép kiểu datetime, report_date, chi_nhanh_HUB,
+    join tham chiếu nội tỉnh (giữ ma_tinh).
+    """
     # Keep needed columns
-    df = df.select(COLS_XUAT_SACH_TTKT)
+    lf = df.lazy().select(columns)
 
     # Correct datetime datatype
-    df = df.with_columns(
+    lf = lf.with_columns(
         [
             pl.col("tg_nhap_buucuc").str.to_datetime("%Y-%m-%d %H:%M:%S"),
             pl.col("tg_laixe_nhan").str.to_datetime("%Y-%m-%d %H:%M:%S"),
         ]
     )
-    lf = df.lazy()
-
-    # Transformation
 
     # Add report_date from import result
-    if import_result.date != "":
-        lf = lf.with_columns(pl.lit(import_result.date).str.strptime(pl.Date, "%d-%m-%Y").alias("report_date"))
+    if date != "":
+        lf = lf.with_columns(pl.lit(date).str.strptime(pl.Date, "%d-%m-%Y").alias("report_date"))
 
-    # Xác định chi nhánh hiện tại theo đơn vị khai thác
-    lf = lf.with_columns(
-        pl.col("don_vi_khaithac").str.slice(3, 3).alias("chi_nhanh_HUB")
-    )
+    # Xác định chi nhánh hiện tại theo đơn vị khai thác (đã gồm HUB override)
+    lf = with_chi_nhanh_hub(lf, ref)
+
+    # Tham chiếu nội tỉnh theo bưu cục phát
+    return with_branch_lookup(lf, ref)
 
-    # Thay thế theo HUB_OVERRIDES
-    if HUB_OVERRIDES:
-        expr = pl.col("chi_nhanh_HUB")
-        for match_value, new_value in HUB_OVERRIDES.items():
-            expr = (
-                pl.when(pl.col("don_vi_khaithac") == match_value)
-                .then(pl.lit(new_value))
-                .otherwise(expr)
-            )
-        lf = lf.with_columns(expr.alias("chi_nhanh_HUB"))
+
+def rule_input(base: pl.LazyFrame, name: str) -> pl.LazyFrame:
+    """Dữ liệu đưa vào bước khớp rule của từng output (RD / KN / TTKT)"""
+    if name == "TTKT":
+        # Tham chiếu miền phát từ bưu cục phát
+        return base.drop(["ma_tinh", "chi_nhanh_HUB"])
 
     # Xác định chi nhánh phát cũ theo lookup
-    lf = (
-        lf.join(
-            lf_lookup, how="left", left_on="ma_buucuc_phat", right_on="ma_buucuc"
-        )
-        .drop("chi_nhanh_phat")
-        .rename({"ma_tinh": "chi_nhanh_phat"})
-    )
+    lf = base.drop("chi_nhanh_phat").rename({"ma_tinh": "chi_nhanh_phat"})
 
     # Phân loại đơn rải đích / kết nối
     lf = lf.with_columns(
@@ -262,69 +339,547 @@ def pipeline_xs_hub(
         .alias("phan_loai")
         .cast(pl.Categorical)
     )
+    return lf.filter(pl.col("phan_loai") == name)
+
 
+def build_hub_outputs(
+    base: pl.LazyFrame,
+    rules: Dict[str, pl.LazyFrame],
+) -> Dict[str, pl.LazyFrame]:
     # Tìm rule và deadline phù hợp với mỗi đơn
-    rules = {"RD": lf_rule_rd, "KN": lf_rule_kn}
-    outputs = {"RD": pl.LazyFrame(), "KN": pl.LazyFrame()}
+    outputs = {}
+    for type in ["RD", "KN"]:
+        filtered = apply_rule(lf=rule_input(base, type), rule=rules[type], type=type)
+        outputs[type] = add_timedelta(filtered)
 
-    for type in outputs.keys():
-        filtered = lf.filter(pl.col("phan_loai") == type)
-        filtered = apply_rule(lf=filtered, rule=rules[type], type=type)
+    return outputs
 
-        # Thêm timedelta
-        filtered = filtered.with_columns(
-            pl.when(pl.col("Result_p") == "Sai hẹn").then((pl.col("tg_laixe_nhan") - pl.col("deadline"))).alias("_time_delta")
-        )
 
-        filtered = filtered.with_columns([
-            (pl.col("_time_delta").abs().dt.total_seconds() // (24 * 60 * 60)).alias("days"),  # Calculate days
-            (pl.col("_time_delta").abs().dt.total_seconds() // 3600 % 24).alias("hours"),   # Calculate hours
-            (pl.col("_time_delta").abs().dt.total_seconds() // 60 % 60).alias("minutes"),    # Calculate minutes
-            (pl.col("_time_delta").abs().dt.total_seconds() % 60).alias("seconds")
-        ])
-
-        filtered = filtered.with_columns(
-            pl.concat_str([
-                pl.col("days").cast(pl.Utf8),
-                pl.lit("."),
-                pl.col("hours").cast(pl.Utf8).str.zfill(2),
-                pl.lit(":"),
-                pl.col("minutes").cast(pl.Utf8).str.zfill(2),
-                pl.lit(":"),
-                pl.col("seconds").cast(pl.Utf8).str.zfill(2),
-            ]).alias("timedelta")
-        )
+def build_ttkt_output(base: pl.LazyFrame, rule: pl.LazyFrame) -> pl.LazyFrame:
+    lf = rule_input(base, "TTKT")
+
+    # Tìm rule và deadline phù hợp với mỗi đơn (Tương tự rule rải đích)
+    lf = apply_rule(lf, rule=rule, type="RD")
+    lf = add_timedelta(lf)
+
+    # Tạo các cột trống làm placeholder
+    return lf.with_columns(
+        [
+            pl.lit(None).alias("CNHUB"),
+            pl.lit(None).alias("phan_loai"),
+        ]
+    )
+
+
+def get_rule_path(config: Dict, name: str, rule_file: Optional[str] = None) -> str:
+    section, folder_key, file_key = RULE_LOCATIONS[name]
+    opts = config[section]
+    return os.path.join(opts[folder_key], rule_file or opts[file_key])
+
+
+def load_rule(config: Dict, name: str, rule_file: Optional[str] = None) -> pl.LazyFrame:
+    """Đọc rule của 1 output (RD / KN / TTKT), mặc định lấy file đang chọn trong config"""
+    rule_path = get_rule_path(config, name, rule_file)
+    rule_type = RULE_TYPES[name]
+
+    # Rule dùng chung giữa các session, chỉ đọc lại khi file đổi
+    rule = load_shared(f"rule_{rule_type}", [rule_path], lambda: import_rule(rule_path, rule_type))
+    return rule.lazy()
+
+
+def load_rules(config: Dict, select: str) -> Dict[str, pl.LazyFrame]:
+    """
+    Đọc rule theo luồng được chọn.
+    select: "hub" → RD, KN / "ttkt" → TTKT / "all" → RD, KN, TTKT
+    """
+    return {name: load_rule(config, name) for name in SELECT_OUTPUTS[select]}
+
+
+def build_outputs(
+    base: pl.LazyFrame,
+    rules: Dict[str, pl.LazyFrame],
+) -> Dict[str, pl.LazyFrame]:
+    outputs: Dict[str, pl.LazyFrame] = {}
+
+    if "RD" in rules:
+        outputs.update(build_hub_outputs(base, {"RD": rules["RD"], "KN": rules["KN"]}))
+    if "TTKT" in rules:
+        outputs["TTKT"] = build_ttkt_output(base, rules["TTKT"])
+
+    return outputs
+
+
+def summarize_results(outputs: Dict[str, pl.LazyFrame]) -> pl.DataFrame:
+    """Số dòng theo Result_p của từng output (collect song song)"""
+    names = list(outputs.keys())
+    counts = pl.collect_all(
+        [
+            outputs[name].group_by("Result_p").agg(pl.len().alias("so_dong"))
+            .with_columns(pl.lit(name).alias("output"))
+            for name in names
+        ]
+    )
+    return pl.concat(counts).select(["output", "Result_p", "so_dong"]).sort(["output", "Result_p"])
+
+
+def profile_outputs(outputs: Dict[str, pl.LazyFrame]) -> Dict[str, Dict]:
+    """
+    Plan đã tối ưu và thời gian chạy từng node (µs) của mỗi output.
+    Chạy lại toàn bộ plan 1 lần, chỉ dùng khi bật chế độ profiling.
+    """
+    profiles = {}
+
+    for name, lf in outputs.items():
+        _, timings = lf.profile()
+        profiles[name] = {
+            "plan": lf.explain(optimized=True),
+            "timings": timings.with_columns(
+                (pl.col("end") - pl.col("start")).alias("duration_us")
+            ).sort("duration_us", descending=True),
+        }
+
+    return profiles
+
+
+def profile_stages(plan: pl.LazyFrame, rules: Dict[str, pl.LazyFrame]) -> Dict[str, Dict]:
+    """
+    Như profile_outputs cho bản polars không có LazyFrame.profile: đo từng bước
+    (prepare_base, join / lọc rule, gán Result_p, add_timedelta) bằng collect riêng,
+    mỗi bước chạy trên kết quả đã collect của bước trước.
+    """
+    def timed(lf: pl.LazyFrame) -> tuple[pl.DataFrame, int]:
+        start = time.perf_counter()
+        df = lf.collect()
+        return df, int((time.perf_counter() - start) * 1_000_000)
+
+    base, base_us = timed(plan)
+    outputs = build_outputs(plan, rules)
+    profiles = {}
+
+    for name, rule in rules.items():
+        stages = [
+            ("rule join/filter", lambda lf: match_rule(rule_input(lf, name), rule, RULE_TYPES[name])),
+            ("Result_p", label_result),
+            ("add_timedelta", add_timedelta),
+        ]
+        nodes, durations = ["prepare_base"], [base_us]
+        df = base
+        for node, stage in stages:
+            df, duration = timed(stage(df.lazy()))
+            nodes.append(node)
+            durations.append(duration)
+
+        ends = pl.Series(durations, dtype=pl.Int64).cum_sum()
+        profiles[name] = {
+            "plan": outputs[name].explain(optimized=True),
+            "timings": pl.DataFrame(
+                {"node": nodes, "start": ends - pl.Series(durations, dtype=pl.Int64), "end": ends}
+            )
+            .with_columns((pl.col("end") - pl.col("start")).alias("duration_us"))
+            .sort("duration_us", descending=True),
+        }
+
+    return profiles
+
+
+def save_profiles(profiles: Dict[str, Dict], config: Dict, export_suffix: str) -> list[str]:
+    """Lưu plan (.txt) và thời gian từng node (.csv) cạnh file output"""
+    paths = []
+
+    for name, profile in profiles.items():
+        folder, file_name, _ = output_target(config, name, export_suffix)
+        stem = os.path.join(folder, os.path.splitext(file_name)[0])
 
-        # Cleanup sau khi thêm timedelta
-        outputs[type] = filtered.drop(["days", "hours", "minutes","seconds", "_time_delta"])
+        with open(f"{stem}_plan.txt", "w", encoding="utf-8") as f:
+            f.write(profile["plan"])
+        paths.append(f"{stem}_plan.txt")
 
-        
+        profile["timings"].write_csv(f"{stem}_profile.csv")
+        paths.append(f"{stem}_profile.csv")
 
-    # --- Export ---
+    return paths
 
-    fn_map = {"RD": "RaiDich", "KN": "KetNoi"}
-    output_path = {"RD": opts["output_rd_folder"], "KN": opts["output_kn_folder"]}
+
+# --- Export ---
+
+def output_target(config: Dict, name: str, export_suffix: str) -> tuple[str, str, Dict]:
+    """Folder, tên file và option ghi csv của từng output (RD / KN / TTKT)"""
+    if name == "TTKT":
+        folder = config["xuat_sach_ttkt"]["output_folder"]
+        return folder, f"XuatsachTTKT_{export_suffix}.csv", TTKT_CSV_OPTIONS
+
+    opts = config["xuat_sach_hub"]
+    folder = opts["output_rd_folder"] if name == "RD" else opts["output_kn_folder"]
+    return folder, f"XuatsachHUB{HUB_FILE_NAMES[name]}_{export_suffix}.csv", {}
+
+
+def get_partition_column(config: Dict, lf: pl.LazyFrame) -> Optional[str]:
+    """Cột tách file theo cấu hình, None nếu không tách hoặc output không có cột đó"""
+    column = config["pipeline_options"].get("partition_by")
+    if column and column in lf.collect_schema().names():
+        return column
+    return None
+
+
+def partition_path(folder: str, file_name: str, value) -> str:
+    """Thư mục con + tên file của 1 nhánh, vd: output/BDG/XuatsachHUBRaiDich_01-01-2025_BDG.csv"""
+    # Bỏ ký tự không hợp lệ và dấu chấm / khoảng trắng ở 2 đầu ("", ".", ".." không thành thư mục)
+    label = PARTITION_UNSAFE_CHARS.sub("_", str(value)).strip(" .") if value is not None else ""
+    label = label or PARTITION_NULL_LABEL
+    part_folder = os.path.join(folder, label)
+    os.makedirs(part_folder, exist_ok=True)
+
+    stem, ext = os.path.splitext(file_name)
+    return os.path.join(part_folder, f"{stem}_{label}{ext}")
+
+
+def export_output(
+    name: str,
+    lf: pl.LazyFrame,
+    config: Dict,
+    export_suffix: str,
+) -> list[str]:
+    """Ghi 1 output, trả về đường dẫn các file đã ghi"""
+    folder, file_name, csv_opts = output_target(config, name, export_suffix)
+    partition_column = get_partition_column(config, lf)
+
+    if partition_column is None:
+        path = os.path.join(folder, file_name)
+        lf.sink_csv(path, **csv_opts)
+        return [path]
+
+    return write_partitioned(lf.collect(), folder, file_name, partition_column, csv_opts, set())
+
+
+def export_outputs(
+    outputs: Dict[str, pl.LazyFrame],
+    config: Dict,
+    export_suffix: str,
+    run_dir: Optional[str] = None,
+) -> list[str]:
     output_files = []
-    rows_out = 0
 
-    if import_result.date == "":
-        export_suffix = time.strftime("%Y%m%d_%H%M%S")
-    else:
-        export_suffix = import_result.date
-        
-    for type in outputs.keys():
-        rows_out += outputs[type].select(pl.len()).collect().item()
-        file_name = f"XuatsachHUB{fn_map[type]}_{export_suffix}.csv"
-        outputs[type].sink_csv(
-            os.path.join(output_path[type], file_name)
-        )
-        output_files.append(file_name)
+    for name, lf in outputs.items():
+        if run_dir is None:
+            paths = export_output(name, lf, config, export_suffix)
+        else:
+            # Bỏ qua output đã ghi xong ở lần chạy trước (cùng rule, cùng đích ghi)
+            folder, file_name, _ = output_target(config, name, export_suffix)
+            stamp = files_stamp([get_rule_path(config, name)]) + [
+                folder, file_name, get_partition_column(config, lf)
+            ]
+            paths = done_output_paths(run_dir, name, stamp)
+            if paths is None:
+                paths = export_output(name, lf, config, export_suffix)
+                mark_output_done(run_dir, name, stamp, paths)
+
+        output_files.extend(os.path.basename(p) for p in paths)
+
+    return output_files
+
+
+def append_csv(df: pl.DataFrame, path: str, first: bool, csv_opts: Dict) -> None:
+    """Ghi đè (batch đầu, có header) hoặc ghi nối (các batch sau) vào file csv"""
+    with open(path, "wb" if first else "ab") as f:
+        df.write_csv(f, include_header=first, **csv_opts)
+
+
+def append_batch_output(
+    lf: pl.LazyFrame,
+    folder: str,
+    file_name: str,
+    csv_opts: Dict,
+    partition_column: Optional[str],
+    written: set[str],
+    max_bytes: int,
+) -> int:
+    """
+    Out-of-core: ghi kết quả 1 batch vào file output (hoặc từng file nhánh), trả về số dòng.
+    - Không tách nhánh, batch đầu: sink_csv thẳng ra file đích
+    - Còn lại: chạy plan 1 lần (streaming) ra parquet tạm, đọc lại từng phần vừa max_bytes
+      rồi ghi nối (tách nhánh bằng write_partitioned, 1 lần duyệt mỗi phần)
+    """
+    path = os.path.join(folder, file_name)
+    if partition_column is None and path not in written:
+        lf.sink_csv(path, **csv_opts)
+        written.add(path)
+        return pl.scan_csv(path, infer_schema=False).select(pl.len()).collect().item()
+
+    tmp_path = os.path.join(folder, f".{file_name}.batch.parquet")
+    lf.sink_parquet(tmp_path)
+
+    try:
+        scan = pl.scan_parquet(tmp_path)
+        rows = scan.select(pl.len()).collect().item()
+
+        # Số phần cần đọc để mỗi phần (đã giải nén) không vượt max_bytes
+        n_chunks = max(1, -(-os.path.getsize(tmp_path) * PARQUET_MEMORY_FACTOR // max_bytes))
+        chunk_rows = max(1, -(-rows // n_chunks))
+
+        for offset in range(0, rows, chunk_rows):
+            chunk = scan.slice(offset, chunk_rows).collect()
+            if partition_column is None:
+                append_csv(chunk, path, False, csv_opts)
+            else:
+                write_partitioned(chunk, folder, file_name, partition_column, csv_opts, written)
+    finally:
+        os.remove(tmp_path)
+
+    return rows
+
+
+def write_partitioned(
+    df: pl.DataFrame,
+    folder: str,
+    file_name: str,
+    column: str,
+    csv_opts: Dict,
+    written: set[str],
+) -> list[str]:
+    """
+    Tách df theo giá trị của column và ghi mỗi nhánh ra 1 file riêng.
+    Chỉ lấy chỉ số dòng của từng nhánh (1 lần duyệt), mỗi lần chỉ tạo bản sao của 1 nhánh
+    thay vì tách cả df cùng lúc.
+    written: các file đã ghi ở batch trước (out-of-core) → ghi nối, không ghi lại header.
+    """
+    paths = []
+
+    groups = (
+        df.select(pl.col(column), pl.int_range(pl.len(), dtype=pl.UInt32).alias("row_idx"))
+        .group_by(column, maintain_order=True)
+        .agg("row_idx")
+    )
+
+    for value, row_idx in zip(groups[column].to_list(), groups["row_idx"]):
+        path = partition_path(folder, file_name, value)
+        append_csv(df[row_idx], path, path not in written, csv_opts)
+        written.add(path)
+        if path not in paths:
+            paths.append(path)
+
+    return paths
+
+
+# --- Pipelines ---
+
+def prepare_input(
+    input_files: list,
+    config: Dict,
+    run_dir: Optional[str] = None,
+) -> PreparedInput:
+    """
+    Đọc file raw và chuẩn bị base dùng chung (chưa áp rule).
+    run_dir: lưu / lấy lại từng file đã đọc và base đã chuẩn bị (chạy lại sau lỗi).
+    """
+    source_files = tuple(file_name(f) for f in input_files)
+    common = config["common"]
+    # Base chỉ dùng lại khi cùng bộ file raw và cùng file tham chiếu
+    base_stamp = [inputs_key(input_files)] + files_stamp(
+        [common["thamchieu_noitinh"], common.get("hub_overrides")]
+    )
+
+    if run_dir is not None:
+        cached = load_base(run_dir, base_stamp)
+        if cached is not None:
+            df, date, rows_in = cached
+            return PreparedInput(df=df, date=date, rows_in=rows_in, source_files=source_files)
+
+    ref = load_reference(config)
+
+    # Ingest raw
+    import_result = import_files(
+        input_files,
+        config["pipeline_options"]["fast_mode"],
+        columns=INPUT_COLUMNS,
+        schema_overrides=INPUT_SCHEMA_OVERRIDES,
+        checkpoint_dir=inputs_dir(run_dir),
+    )
+
+    base = prepare_base(import_result.df, import_result.date, ref, INPUT_COLUMNS)
+    profile = config["pipeline_options"].get("profile") == "True"
+    prepared = PreparedInput(
+        df=base.collect(),
+        date=import_result.date,
+        rows_in=import_result.df.height,
+        source_files=source_files,
+        plan=base if profile else None,
+    )
+
+    if run_dir is not None:
+        save_base(run_dir, prepared.df, prepared.date, prepared.rows_in, base_stamp)
+
+    return prepared
+
+
+def evaluate_rules(
+    prepared: PreparedInput,
+    rules: Dict[str, pl.LazyFrame],
+    config: Dict,
+    export: bool = True,
+    run_dir: Optional[str] = None,
+    export_suffix: Optional[str] = None,
+) -> Dict:
+    """
+    Áp rule lên base đã chuẩn bị: khớp rule, gán Result_p, tổng hợp, ghi output.
+    Dùng lại được khi chỉ đổi file rule (không đọc lại file raw).
+    run_dir: bỏ qua các output đã ghi xong ở lần chạy trước.
+    export_suffix: hậu tố tên file output, mặc định theo ngày báo cáo / giờ chạy.
+    """
+    export_suffix = export_suffix or get_export_suffix(prepared.date)
+    outputs = build_outputs(prepared.df.lazy(), rules)
+    summary = summarize_results(outputs)
+
+    output_files = []
+    if export:
+        output_files = export_outputs(outputs, config, export_suffix, run_dir)
+
+    result = {
+        'rows_in': prepared.rows_in,
+        'rows_out': summary["so_dong"].sum(),
+        'output_files': output_files,
+        'summary': summary,
+        # Không giữ plan (và dữ liệu raw nó tham chiếu) trong session
+        'prepared': replace(prepared, plan=None),
+        'warnings': [],
+    }
+
+    # Debug: plan + thời gian từng node, lưu cùng output
+    if config["pipeline_options"].get("profile") == "True":
+        if prepared.plan is None:
+            result['warnings'].append(
+                "Profiling: base lấy từ checkpoint / lần chạy trước, chỉ đo phần áp rule"
+            )
+        if not PROFILE_SUPPORTED:
+            result['warnings'].append(
+                f"Profiling: polars {pl.__version__} không còn LazyFrame.profile, "
+                "đo thời gian theo từng bước thay cho từng node"
+            )
+
+        # Lỗi khi profiling không làm hỏng lần chạy (output đã ghi xong)
+        try:
+            plan = prepared.plan if prepared.plan is not None else prepared.df.lazy()
+            if PROFILE_SUPPORTED:
+                profiles = profile_outputs(build_outputs(plan, rules))
+            else:
+                profiles = profile_stages(plan, rules)
+            if export:
+                save_profiles(profiles, config, export_suffix)
+            result['profiles'] = profiles
+        except Exception as e:
+            result['warnings'].append(f"Profiling lỗi: {e}")
+
+    return result
+
+
+def preview_pipeline(
+    input_files: list,
+    config: Dict,
+    select: str,
+    n_rows: int = 1000,
+    sample: bool = False,
+) -> Dict:
+    """
+    Chạy thử cùng plan trên n dòng đầu (hoặc n dòng ngẫu nhiên) của mỗi file, không ghi output.
+    Chế độ ngẫu nhiên chỉ lấy mẫu trong PREVIEW_POOL_FACTOR * n dòng đầu để vẫn đọc nhanh.
+    """
+    rules = load_rules(config, select)
+    ref = load_reference(config)
+
+    input_files = list(input_files)
+    pool_rows = n_rows * PREVIEW_POOL_FACTOR if sample else n_rows
+
+    # Đọc / lấy mẫu riêng từng file để file nào cũng có mặt trong bản xem trước
+    frames = []
+    for file in input_files:
+        df_file = import_files(
+            [file],
+            config["pipeline_options"]["fast_mode"],
+            n_rows=pool_rows,
+            columns=INPUT_COLUMNS,
+            schema_overrides=INPUT_SCHEMA_OVERRIDES,
+        ).df
+        if sample:
+            df_file = df_file.sample(n=min(n_rows, df_file.height), shuffle=True)
+        frames.append(df_file)
+    df = pl.concat(frames, rechunk=True)
+
+    base = prepare_base(df, extract_date(input_files), ref, INPUT_COLUMNS).collect().lazy()
+
+    outputs = build_outputs(base, rules)
+    names = list(outputs.keys())
+    collected = pl.collect_all([outputs[name] for name in names])
+    results = dict(zip(names, collected))
+
+    # Cặp key không tìm thấy trong rule
+    unmatched = {
+        name: df_out.filter(pl.col("Result_p") == "Check lại")
+        .group_by(RULE_JOIN_KEYS[RULE_TYPES[name]]["left_on"])
+        .agg(pl.len().alias("so_dong"))
+        .sort("so_dong", descending=True)
+        for name, df_out in results.items()
+    }
 
     return {
-        'rows_in': rows_in,
-        'rows_out': rows_out,
-        'output_files': output_files
+        'rows_in': df.height,
+        'outputs': results,
+        'summary': summarize_results({name: df_out.lazy() for name, df_out in results.items()}),
+        'unmatched': unmatched,
+    }
+
+
+def run_with_checkpoint(
+    input_files: list,
+    config: Dict,
+    rules: Dict[str, pl.LazyFrame],
+) -> Dict:
+    """Chuẩn bị + áp rule, có checkpoint nếu bật; checkpoint bị xóa khi chạy xong toàn bộ"""
+    with open_run_dir(input_files, config) as run_dir:
+        prepared = prepare_input(input_files, config, run_dir)
+        export_suffix = None
+        if run_dir is not None:
+            # Chạy tiếp sau lỗi: giữ tên file output của lần chạy trước
+            export_suffix = run_export_suffix(run_dir, get_export_suffix(prepared.date))
+        result = evaluate_rules(prepared, rules, config, run_dir=run_dir, export_suffix=export_suffix)
+
+        clear_run(run_dir)
+    return result
+
+
+def pipeline_xs_hub(
+    input_files: list,
+    config: Dict
+) -> Dict:
+    """
+    Pipeline Xuất sạch HUB
+    "common": {
+        "thamchieu_noitinh": null,
+        "hub_overrides": null
+    },
+    "xuat_sach_hub": {
+        "rule_rd_folder": null,
+        "rule_rd_file": null,
+        "rule_kn_folder": null,
+        "rule_kn_file": null,
+        "output_rd_folder": "output",
+        "output_kn_folder": "output"
+    },
+    "pipeline_options": {
+        "pipeline_select": null,
+        "fast_mode": false,
+        "out_of_core": false,
+        "memory_cap_mb": 4096,
+        "partition_by": null,
+        "checkpoint": false,
+        "checkpoint_folder": null,
+        "profile": false,
+        "preload": false
     }
+    """
+    if config["pipeline_options"].get("out_of_core") == "True":
+        return pipeline_out_of_core(input_files, config, "hub")
+
+    rules = load_rules(config, "hub")
+    return run_with_checkpoint(input_files, config, rules)
 
 def pipeline_xs_ttkt(
     input_files: list,
@@ -334,7 +889,8 @@ def pipeline_xs_ttkt(
     Pipeline Xuất sạch TTKT
     
     "common": {
-        "thamchieu_noitinh": null
+        "thamchieu_noitinh": null,
+        "hub_overrides": null
     },
     "xuat_sach_ttkt": {
         "rule_folder": null,
@@ -343,107 +899,108 @@ def pipeline_xs_ttkt(
     },
     "pipeline_options": {
         "pipeline_select": null,
-        "fast_mode": false
+        "fast_mode": false,
+        "out_of_core": false,
+        "memory_cap_mb": 4096,
+        "partition_by": null,
+        "checkpoint": false,
+        "checkpoint_folder": null,
+        "profile": false,
+        "preload": false
     }
 
     """
-    # Load options
-    lookup_path = config["common"]["thamchieu_noitinh"]
-    opts = config["xuat_sach_ttkt"]
-    pipeline_cfg = config["pipeline_options"]
-
-    # Load rules & lookup
-    rule_path = os.path.join(opts["rule_folder"], opts["rule_file"])
-    rule = import_rule(rule_path, "RD") # Rule tương tự rule Rải đích
-    rule_lf = rule.lazy()
-
-    lookup = import_lookup(lookup_path)
-    lookup_lf = lookup.lazy()
-
-    # Ingest raw
-    import_result = import_files(input_files, pipeline_cfg["fast_mode"])
-    df = import_result.df
-    rows_in = df.height
-
-    # Keep needed columns
-    df = df.select(COLS_XUAT_SACH_TTKT)
-
-    # Correct datetime datatype
-    df = df.with_columns(
-        [
-            pl.col("tg_nhap_buucuc").str.to_datetime("%Y-%m-%d %H:%M:%S"),
-            pl.col("tg_laixe_nhan").str.to_datetime("%Y-%m-%d %H:%M:%S"),
-        ]
-    )
-    lf = df.lazy()
-
-    # Add report_date from import result
-    if import_result.date != "":
-        lf = lf.with_columns(pl.lit(import_result.date).str.strptime(pl.Date, "%d-%m-%Y").alias("report_date"))
-
-    # Tham chiếu miền phát từ bưu cục phát
-    lf = lf.join(lookup_lf, how="left", left_on="ma_buucuc_phat", right_on="ma_buucuc").drop("ma_tinh")
-
-    # Tìm rule và deadline phù hợp với mỗi đơn (Tương tự rule rải đích)
-    lf = apply_rule(lf, rule=rule_lf, type="RD")
-
-    # Thêm timedelta
-    lf = lf.with_columns(
-        pl.when(pl.col("Result_p") == "Sai hẹn").then((pl.col("tg_laixe_nhan") - pl.col("deadline"))).alias("_time_delta")
-    )
+    if config["pipeline_options"].get("out_of_core") == "True":
+        return pipeline_out_of_core(input_files, config, "ttkt")
 
-    lf = lf.with_columns([
-        (pl.col("_time_delta").abs().dt.total_seconds() // (24 * 60 * 60)).alias("days"),  # Calculate days
-        (pl.col("_time_delta").abs().dt.total_seconds() // 3600 % 24).alias("hours"),   # Calculate hours
-        (pl.col("_time_delta").abs().dt.total_seconds() // 60 % 60).alias("minutes"),    # Calculate minutes
-        (pl.col("_time_delta").abs().dt.total_seconds() % 60).alias("seconds")
-    ])
+    rules = load_rules(config, "ttkt")
+    return run_with_checkpoint(input_files, config, rules)
 
-    lf = lf.with_columns(
-        pl.concat_str([
-            pl.col("days").cast(pl.Utf8),
-            pl.lit("."),
-            pl.col("hours").cast(pl.Utf8).str.zfill(2),
-            pl.lit(":"),
-            pl.col("minutes").cast(pl.Utf8).str.zfill(2),
-            pl.lit(":"),
-            pl.col("seconds").cast(pl.Utf8).str.zfill(2),
-        ]).alias("timedelta")
-    )
+def pipeline_xs_all(
+    input_files: list,
+    config: Dict
+) -> Dict:
+    """
+    Chạy cả Xuất sạch HUB và TTKT trên cùng 1 lần đọc file raw.
+    Config gồm đủ các mục của pipeline_xs_hub và pipeline_xs_ttkt.
+    """
+    if config["pipeline_options"].get("out_of_core") == "True":
+        return pipeline_out_of_core(input_files, config, "all")
 
-    # Cleanup sau khi thêm timedelta
-    lf = lf.drop(["days", "hours", "minutes","seconds", "_time_delta"])
+    rules = load_rules(config, "all")
+    return run_with_checkpoint(input_files, config, rules)
 
-    # Tạo các cột trống làm placeholder
-    lf = lf.with_columns(
-        [
-            pl.lit(None).alias("CNHUB"),
-            pl.lit(None).alias("phan_loai"),
-        ]
-    )
 
-    # --- Export ---
+def pipeline_out_of_core(
+    input_files: list,
+    config: Dict,
+    select: str,
+) -> Dict:
+    """
+    Chạy pipeline theo từng batch bằng streaming engine, ghi nối kết quả vào file output
+    sau mỗi batch, không giữ kết quả trong bộ nhớ.
+    - csv: scan theo từng ngày, RAM không phụ thuộc dung lượng file
+    - xlsx: phải đọc hết từng file, gom batch theo pipeline_options.memory_cap_mb;
+      file đơn lẻ vượt giới hạn vẫn chạy nhưng có cảnh báo
+    select: "hub" / "ttkt" / "all"
+    """
+    pipeline_cfg = config["pipeline_options"]
+    memory_cap_mb = int(pipeline_cfg.get("memory_cap_mb") or DEFAULT_MEMORY_CAP_MB)
+    max_bytes = memory_cap_mb * 1024 * 1024
 
-    if import_result.date == "":
-        export_suffix = time.strftime("%Y%m%d_%H%M%S")
-    else:
-        export_suffix = import_result.date
+    # Load rules & lookup
+    rules = load_rules(config, select)
+    ref = load_reference(config)
 
-    file_name = f"XuatsachTTKT_{export_suffix}.csv"
+    input_files = list(input_files)
+    export_suffix = get_export_suffix(extract_date(input_files))
 
-    # Count rows
-    rows_out = lf.select(pl.len()).collect().item()
+    warnings = [
+        f"{name}: RAM ước lượng khi đọc vượt giới hạn {memory_cap_mb} MB"
+        for name in oversized_files(input_files, max_bytes)
+    ]
 
-    # Write csv
-    lf.sink_csv(
-        os.path.join(opts["output_folder"], file_name),
-        datetime_format="%Y-%m-%d %H:%M:%S",
-        date_format= "%Y-%m-%d",
-        time_format="%H:%M:%S"
-    )
+    rows_in = 0
+    rows_out = 0
+    output_columns: Dict[str, list[str]] = {}
+    written: set[str] = set()
+
+    with open_run_dir(input_files, config) as run_dir:
+        batches = iter_import_batches(
+            input_files,
+            pipeline_cfg["fast_mode"],
+            max_bytes,
+            columns=INPUT_COLUMNS,
+            schema_overrides=INPUT_SCHEMA_OVERRIDES,
+            checkpoint_dir=inputs_dir(run_dir),
+        )
+        for batch in batches:
+            rows_in += batch.lf.select(pl.len()).collect(engine="streaming").item()
+
+            base = prepare_base(batch.lf, batch.date, ref, INPUT_COLUMNS)
+            if batch.date == "":
+                # Giữ schema giống các batch có ngày
+                base = base.with_columns(pl.lit(None, dtype=pl.Date).alias("report_date"))
+            if select == "all" and not batch.streamed:
+                # Dữ liệu đã nằm trong RAM: chuẩn bị 1 lần cho cả 3 output
+                base = base.collect().lazy()
+
+            for name, lf in build_outputs(base, rules).items():
+                # Cố định thứ tự cột theo batch đầu tiên
+                if name not in output_columns:
+                    output_columns[name] = lf.collect_schema().names()
+                lf = lf.select(output_columns[name])
+
+                folder, file_name, csv_opts = output_target(config, name, export_suffix)
+                rows_out += append_batch_output(
+                    lf, folder, file_name, csv_opts, get_partition_column(config, lf), written, max_bytes
+                )
+
+        clear_run(run_dir)
 
     return {
         'rows_in': rows_in,
         'rows_out': rows_out,
-        'output_files': file_name
-    }
\ No newline at end of file
+        'output_files': [os.path.basename(p) for p in written],
+        'warnings': warnings,
+    }
@@ -0,0 +1,108 @@
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import polars as pl
+
+from utils.cache import load_shared
+
+# --- Config ---
+
+DEFAULT_HUB_OVERRIDES = {
+    # don_vi_khai_thac: chi_nhanh_HUB
+    "HUBTAN": "BDG",
+    "HUBBHD": "BDH",
+}
+
+OVERRIDE_KEY_COL = "don_vi_khai_thac"
+OVERRIDE_VALUE_COL = "chi_nhanh_HUB"
+
+
+@dataclass(frozen=True)
+class ReferenceDimensions:
+    # Bảng HUB override đã mã hóa sẵn thành 2 mảng key / value cho replace_strict
+    hub_keys: pl.Series
+    hub_values: pl.Series
+    # Bảng tham chiếu nội tỉnh: 1 dòng / ma_buucuc
+    branch: pl.DataFrame
+
+
+# --- Loaders ---
+
+def import_lookup(file_path: str) -> pl.DataFrame:
+    df = pl.read_excel(file_path)
+    # Pending validation logic
+    return df
+
+
+def import_hub_overrides(file_path: Optional[str]) -> Dict[str, str]:
+    """
+    Đọc bảng HUB override từ file Excel (cột don_vi_khai_thac, chi_nhanh_HUB).
+    Không cấu hình file thì dùng DEFAULT_HUB_OVERRIDES.
+    """
+    if not file_path:
+        return dict(DEFAULT_HUB_OVERRIDES)
+
+    df = pl.read_excel(
+        file_path,
+        columns=[OVERRIDE_KEY_COL, OVERRIDE_VALUE_COL],
+        schema_overrides={OVERRIDE_KEY_COL: pl.String, OVERRIDE_VALUE_COL: pl.String},
+    )
+    df = df.drop_nulls().unique(subset=OVERRIDE_KEY_COL, keep="last", maintain_order=True)
+
+    return dict(zip(df[OVERRIDE_KEY_COL].to_list(), df[OVERRIDE_VALUE_COL].to_list()))
+
+
+def build_reference(
+    lookup: pl.DataFrame,
+    overrides: Dict[str, str],
+) -> ReferenceDimensions:
+    # Bỏ trùng ma_buucuc để join không nhân dòng
+    branch = lookup.with_columns(pl.col("ma_buucuc").cast(pl.String)).unique(
+        subset="ma_buucuc", keep="first", maintain_order=True
+    )
+
+    return ReferenceDimensions(
+        hub_keys=pl.Series(list(overrides.keys()), dtype=pl.String),
+        hub_values=pl.Series(list(overrides.values()), dtype=pl.String),
+        branch=branch,
+    )
+
+
+def load_reference(config: Dict) -> ReferenceDimensions:
+    """Bảng tham chiếu dùng chung giữa các session, chỉ đọc lại khi file đổi"""
+    lookup_path = config["common"]["thamchieu_noitinh"]
+    overrides_path = config["common"].get("hub_overrides")
+
+    return load_shared(
+        "reference",
+        [lookup_path, overrides_path],
+        lambda: build_reference(
+            lookup=import_lookup(lookup_path),
+            overrides=import_hub_overrides(overrides_path),
+        ),
+    )
+
+
+# --- Apply ---
+
+def with_chi_nhanh_hub(lf: pl.LazyFrame, ref: ReferenceDimensions) -> pl.LazyFrame:
+    """Chi nhánh HUB = ký tự 4-6 của đơn vị khai thác, trừ các đơn vị có override."""
+    default = pl.col("don_vi_khaithac").str.slice(3, 3)
+
+    if ref.hub_keys.is_empty():
+        return lf.with_columns(default.alias("chi_nhanh_HUB"))
+
+    return lf.with_columns(
+        pl.col("don_vi_khaithac")
+        .replace_strict(
+            ref.hub_keys, ref.hub_values, default=default, return_dtype=pl.String
+        )
+        .alias("chi_nhanh_HUB")
+    )
+
+
+def with_branch_lookup(lf: pl.LazyFrame, ref: ReferenceDimensions) -> pl.LazyFrame:
+    """Join bảng tham chiếu nội tỉnh theo bưu cục phát."""
+    return lf.join(
+        ref.branch.lazy(), how="left", left_on="ma_buucuc_phat", right_on="ma_buucuc"
+    )
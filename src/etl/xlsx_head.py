@@ -0,0 +1,287 @@
+"""
+Đọc n dòng đầu của file XLSX mà không parse cả sheet.
+
+calamine (pl.read_excel) luôn đọc hết sheet rồi mới cắt n_rows, nên xem trước trên file
+lớn gần như tốn bằng chạy thật. Ở đây đọc trực tiếp XML trong file zip theo dạng stream
+và dừng ngay khi đủ dòng; shared strings cũng chỉ đọc tới chỉ số lớn nhất cần dùng.
+Giá trị trả về dạng chuỗi, cùng định dạng với fastexcel khi ép kiểu String.
+"""
+
+import posixpath
+import re
+import zipfile
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import Dict, Iterator, Optional
+from xml.etree.ElementTree import Element, iterparse
+
+import polars as pl
+
+# Mã định dạng số có sẵn của Excel dành cho ngày giờ
+BUILTIN_DATE_FORMATS = set(range(14, 23)) | set(range(27, 37)) | set(range(45, 48)) | set(range(50, 59))
+DATE_FORMAT_CODE = re.compile(r"[dmyhs]", re.IGNORECASE)
+FORMAT_LITERALS = re.compile(r'"[^"]*"|\[[^\]]*\]|\\.')
+CELL_COLUMN = re.compile(r"[A-Z]+")
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+GENERAL_WIDTH = 11
+
+
+def _tag(elem: Element) -> str:
+    # Bỏ namespace (transitional / strict OOXML dùng namespace khác nhau)
+    return elem.tag.rsplit("}", 1)[-1]
+
+
+def _attr(elem: Element, name: str) -> Optional[str]:
+    for key, value in elem.attrib.items():
+        if key.rsplit("}", 1)[-1] == name:
+            return value
+    return None
+
+
+def _iter_end(zf: zipfile.ZipFile, path: str) -> Iterator[Element]:
+    with zf.open(path) as f:
+        for _, elem in iterparse(f, events=("end",)):
+            yield elem
+
+
+def _column_index(ref: str) -> int:
+    index = 0
+    for char in CELL_COLUMN.match(ref).group():  # pyright: ignore[reportOptionalMemberAccess]
+        index = index * 26 + ord(char) - ord("A") + 1
+    return index - 1
+
+
+def _sheet_paths(zf: zipfile.ZipFile) -> tuple[list[str], datetime]:
+    """Đường dẫn các sheet theo thứ tự trong workbook, kèm mốc ngày (1900 / 1904)"""
+    rels = {}
+    for elem in _iter_end(zf, "xl/_rels/workbook.xml.rels"):
+        if _tag(elem) == "Relationship":
+            target = elem.attrib["Target"]
+            rels[elem.attrib["Id"]] = (
+                target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+            )
+
+    paths = []
+    epoch = datetime(1899, 12, 30)
+    for elem in _iter_end(zf, "xl/workbook.xml"):
+        if _tag(elem) == "sheet":
+            paths.append(rels[_attr(elem, "id")])
+        elif _tag(elem) == "workbookPr" and elem.attrib.get("date1904") in ("1", "true"):
+            epoch = datetime(1904, 1, 1)
+
+    return paths, epoch
+
+
+def _date_styles(zf: zipfile.ZipFile) -> set[int]:
+    """Chỉ số style (thuộc tính s của ô) có định dạng ngày giờ"""
+    if "xl/styles.xml" not in zf.namelist():
+        return set()
+
+    custom: Dict[int, str] = {}
+    xf_formats: list[int] = []
+    in_cell_xfs = False
+    with zf.open("xl/styles.xml") as f:
+        for event, elem in iterparse(f, events=("start", "end")):
+            tag = _tag(elem)
+            if tag == "cellXfs":
+                in_cell_xfs = event == "start"
+            elif event == "end" and tag == "numFmt":
+                custom[int(elem.attrib["numFmtId"])] = elem.attrib.get("formatCode", "")
+            elif event == "end" and tag == "xf" and in_cell_xfs:
+                xf_formats.append(int(elem.attrib.get("numFmtId", 0)))
+
+    def is_date(fmt_id: int) -> bool:
+        if fmt_id in custom:
+            return bool(DATE_FORMAT_CODE.search(FORMAT_LITERALS.sub("", custom[fmt_id])))
+        return fmt_id in BUILTIN_DATE_FORMATS
+
+    return {i for i, fmt_id in enumerate(xf_formats) if is_date(fmt_id)}
+
+
+def _shared_strings(zf: zipfile.ZipFile, max_index: int) -> list[str]:
+    """Đọc shared strings tới chỉ số max_index (không đọc cả bảng)"""
+    strings: list[str] = []
+    if max_index < 0 or "xl/sharedStrings.xml" not in zf.namelist():
+        return strings
+
+    for elem in _iter_end(zf, "xl/sharedStrings.xml"):
+        if _tag(elem) != "si":
+            continue
+        # Bỏ phần phiên âm (rPh), chỉ ghép các đoạn text chính
+        parts = [child.text or "" for child in elem if _tag(child) == "t"]
+        for run in (child for child in elem if _tag(child) == "r"):
+            parts.extend(t.text or "" for t in run if _tag(t) == "t")
+        strings.append("".join(parts))
+        elem.clear()
+        if len(strings) > max_index:
+            break
+
+    return strings
+
+
+def _number_text(value: str, date: bool, epoch: datetime) -> str:
+    """Ô số → chuỗi giống fastexcel (calamine) khi ép kiểu String"""
+    number = float(value)
+    if date:
+        # calamine: hệ 1900 cộng 1 ngày cho serial < 60 (lỗi năm nhuận 1900 của Excel),
+        # làm tròn tới mili giây (số thực hay lệch ngay dưới giây chẵn)
+        if epoch.year == 1899 and number < 60:
+            number += 1
+        dt = epoch + timedelta(milliseconds=round(number * 86_400_000))
+        text = dt.strftime(DATETIME_FORMAT)
+        return f"{text}.{dt.microsecond // 1000:03d}" if dt.microsecond else text
+
+    if number.is_integer():
+        return str(int(number))
+    # Như định dạng General của Excel: tối đa GENERAL_WIDTH ký tự (gồm dấu và dấu chấm)
+    int_digits = len(str(int(abs(number))))
+    decimals = max(0, GENERAL_WIDTH - 1 - int_digits - (number < 0))
+    return f"{number:.{decimals}f}".rstrip("0").rstrip(".")
+
+
+def _read_rows(
+    zf: zipfile.ZipFile,
+    path: str,
+    n_rows: int,
+    header_row: int,
+    date_styles: set[int],
+    epoch: datetime,
+) -> list[dict]:
+    """
+    Đọc dòng header + tối đa n_rows dòng dữ liệu của 1 sheet.
+    Ô shared string được giữ dạng (chỉ số,) để tra sau.
+    """
+    rows: list[dict] = []
+    position = -1
+
+    for elem in _iter_end(zf, path):
+        if _tag(elem) != "row":
+            continue
+
+        position = int(elem.attrib["r"]) - 1 if "r" in elem.attrib else position + 1
+        if position < header_row:
+            elem.clear()
+            continue
+
+        cells = {}
+        for pos, cell in enumerate(c for c in elem if _tag(c) == "c"):
+            ref = cell.attrib.get("r")
+            col = _column_index(ref) if ref else pos
+            kind = cell.attrib.get("t", "n")
+            value = next((child.text for child in cell if _tag(child) == "v"), None)
+
+            if kind == "inlineStr":
+                cells[col] = "".join(t.text or "" for t in cell.iter() if _tag(t) == "t")
+            elif value is None or kind == "e":
+                continue
+            elif kind == "s":
+                cells[col] = (int(value),)
+            elif kind == "b":
+                cells[col] = "true" if value == "1" else "false"
+            elif kind == "n":
+                cells[col] = _number_text(value, int(cell.attrib.get("s", 0)) in date_styles, epoch)
+            else:  # str, d
+                cells[col] = value
+
+        rows.append(cells)
+        elem.clear()
+        if len(rows) > n_rows:
+            break
+
+    return rows
+
+
+def read_xlsx_head(
+    source,
+    n_rows: int,
+    header_row: int = 0,
+    columns: Optional[list[str]] = None,
+    schema_overrides: Optional[Dict[str, pl.DataType]] = None,
+) -> pl.DataFrame:
+    """
+    n_rows dòng dữ liệu đầu tiên của mỗi sheet (header ở dòng header_row, tính từ 0).
+    source: đường dẫn hoặc bytes của file.
+    """
+    with zipfile.ZipFile(BytesIO(source) if isinstance(source, bytes) else source) as zf:
+        sheet_paths, epoch = _sheet_paths(zf)
+        date_styles = _date_styles(zf)
+        sheets = [_read_rows(zf, path, n_rows, header_row, date_styles, epoch) for path in sheet_paths]
+
+        max_index = max(
+            (v[0] for rows in sheets for cells in rows for v in cells.values() if isinstance(v, tuple)),
+            default=-1,
+        )
+        strings = _shared_strings(zf, max_index)
+
+    dfs = []
+    for rows in sheets:
+        if not rows:
+            continue
+        rows = [{col: strings[v[0]] if isinstance(v, tuple) else v for col, v in cells.items()} for cells in rows]
+
+        # Tên cột trùng thì lấy cột đầu tiên
+        header: Dict[str, int] = {}
+        for col, name in sorted(rows[0].items()):
+            header.setdefault(name, col)
+        names = columns if columns is not None else list(header)
+        missing = [name for name in names if name not in header]
+        if missing:
+            raise ValueError(f"Missing columns in sheet: {', '.join(missing)}")
+
+        data = {name: [cells.get(header[name]) for cells in rows[1:]] for name in names}
+        dfs.append(pl.DataFrame(data, schema={name: pl.String for name in names}))
+
+    if not dfs:
+        return pl.DataFrame(schema={name: pl.String for name in columns or []})
+
+    df = pl.concat(dfs, rechunk=True)
+    if schema_overrides:
+        df = df.cast({name: dtype for name, dtype in schema_overrides.items() if name in df.columns})
+    return df
+
+
+def diff_with_full_read(source, n_rows: int, header_row: int = 0) -> pl.DataFrame:
+    """
+    Kiểm tra read_xlsx_head với cách đọc đầy đủ (pl.read_excel / calamine) trên cùng workbook:
+    số ô khác nhau của từng cột (các cột đều đọc dạng chuỗi).
+    """
+    import fastexcel
+
+    head = read_xlsx_head(source, n_rows, header_row)
+    overrides = {name: pl.String for name in head.columns}
+    full = pl.concat(
+        [
+            pl.read_excel(
+                source,
+                sheet_name=sheet_name,
+                columns=head.columns,
+                schema_overrides=overrides,
+                read_options={"header_row": header_row, "n_rows": n_rows},
+            )
+            for sheet_name in fastexcel.read_excel(source).sheet_names
+        ],
+        rechunk=True,
+    )
+
+    if full.height != head.height:
+        raise ValueError(f"Số dòng khác nhau: head {head.height}, full {full.height}")
+
+    return pl.DataFrame(
+        {
+            "cot": head.columns,
+            "so_o_khac": [
+                head[name].ne_missing(full[name]).sum() for name in head.columns
+            ],
+        }
+    )
+
+
+if __name__ == "__main__":
+    # python -m etl.xlsx_head <file.xlsx> [n_rows]
+    import sys
+
+    from etl.ingest import XLSX_HEADER_ROW
+
+    diff = diff_with_full_read(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 1000, XLSX_HEADER_ROW)
+    print(diff.filter(pl.col("so_o_khac") > 0) if diff["so_o_khac"].sum() else "Khớp với pl.read_excel")
+    sys.exit(1 if diff["so_o_khac"].sum() else 0)
@@ -19,7 +19,7 @@ def synced_textbox(label, config_key, **textbox_kwargs):
         _set_nested_value(st.session_state.config_data, config_key, choice)
 
 def synced_radio(label, options, config_key, **radio_kwargs):
-    current = _get_nested_value(st.session_state.config_data, options[0])
+    current = _get_nested_value(st.session_state.config_data, config_key)
 
     # Ensure current value exists in options
     if current not in options:
@@ -35,7 +35,7 @@ def synced_radio(label, options, config_key, **radio_kwargs):
 
 
 def synced_selectbox(label, options, config_key, **selectbox_kwargs):
-    current = _get_nested_value(st.session_state.config_data, options[0])
+    current = _get_nested_value(st.session_state.config_data, config_key)
     
     # Ensure current value exists in options
     if current not in options:
@@ -52,7 +52,7 @@ def synced_selectbox(label, options, config_key, **selectbox_kwargs):
 
 
 def synced_segment_control(label, options, config_key, **radio_kwargs):
-    current = _get_nested_value(st.session_state.config_data, options[0])
+    current = _get_nested_value(st.session_state.config_data, config_key)
     choice = st.segmented_control(label, options, default=current, **radio_kwargs)
     if choice != current:
         update_config(config_key, choice)
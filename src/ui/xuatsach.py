@@ -1,30 +1,61 @@
 import time
 import traceback
+from contextlib import contextmanager
 import streamlit as st
 import ui.ui_components as ui
-from etl.pipeline_xuatsach import pipeline_xs_hub, pipeline_xs_ttkt
+from etl.options import PARTITION_COLUMNS, RULE_LOCATIONS, SELECT_OUTPUTS
 from utils.io import get_folder_child
+from utils.scheduler import SCHEDULER
+from utils.startup import compare_module, import_times, pipeline_module
 
 
 PIPELINES = {
     "xuat_sach_hub": {
-        "func": pipeline_xs_hub,
+        "func": "pipeline_xs_hub",
         "display_name": "Xuất sạch Kho vùng tỉnh (HUB)"
     },
     "xuat_sach_ttkt": {
-        "func": pipeline_xs_ttkt,
+        "func": "pipeline_xs_ttkt",
         "display_name": "Xuất sạch TTKT / LOG"
+    },
+    "xuat_sach_all": {
+        "func": "pipeline_xs_all",
+        "display_name": "Xuất sạch HUB + TTKT"
     }
 }
 
+SELECT_KEYS = {
+    "Xuất sạch Kho vùng tỉnh (HUB)": "hub",
+    "Xuất sạch TTKT": "ttkt",
+    "Xuất sạch HUB + TTKT": "all",
+}
+
 CONFIG = ui.init_session_state()
 
+
+@contextmanager
+def scheduler_slot(estimate_bytes: int):
+    """Chờ lượt trong hàng đợi chung của server (chạy, xem trước, so sánh)"""
+    options = CONFIG["pipeline_options"]
+    SCHEDULER.configure(
+        int(options.get("max_concurrent_runs") or 1),
+        int(options.get("memory_ceiling_mb") or 0) * 1024 * 1024,
+    )
+    queue_info = st.empty()
+
+    with SCHEDULER.slot(
+        estimate_bytes,
+        on_wait=lambda position: queue_info.info(f"Đang chờ lượt chạy: vị trí {position} trong hàng đợi"),
+    ):
+        queue_info.empty()
+        yield
+
 # ----- Main page -----
 
 st.title("Báo cáo Xuất sạch")
 
-tab1, tab2, tab3 = st.tabs(
-    ["Mô tả luồng", "Cài đặt", "Chạy xử lý"], default="Chạy xử lý"
+tab1, tab2, tab3, tab4 = st.tabs(
+    ["Mô tả luồng", "Cài đặt", "Chạy xử lý", "So sánh kết quả"], default="Chạy xử lý"
 )
 
 with tab1:  # Mô tả luồng, yêu cầu file
@@ -42,6 +73,10 @@ with tab1:  # Mô tả luồng, yêu cầu file
 with tab2:  # Config luồng
     st.subheader("Cài đặt chung")
     ui.synced_textbox("File tham chiếu nội tỉnh cũ (Excel)", ["common", "thamchieu_noitinh"])
+    ui.synced_textbox(
+        "File HUB override (Excel, cột don_vi_khai_thac / chi_nhanh_HUB) - để trống dùng mặc định",
+        ["common", "hub_overrides"],
+    )
     st.divider()
     
     st.markdown("### Xuất sạch HUB")
@@ -66,6 +101,72 @@ with tab2:  # Config luồng
         """
     )
     ui.synced_radio("", ["True", "False"], ["pipeline_options", "fast_mode"], label_visibility="collapsed")
+    st.markdown(
+        """
+        **Out-of-core mode**: Xử lý lần lượt từng ngày bằng streaming và ghi nối vào output,
+        dùng cho dữ liệu cả tháng. File csv không bị giới hạn dung lượng; file xlsx phải đọc hết
+        từng file nên được gom nhóm theo giới hạn RAM (file quá lớn sẽ có cảnh báo).
+        """
+    )
+    ui.synced_radio(
+        "Out-of-core mode", ["False", "True"], ["pipeline_options", "out_of_core"], label_visibility="collapsed"
+    )
+    ui.synced_textbox("Giới hạn RAM (MB)", ["pipeline_options", "memory_cap_mb"])
+    st.markdown(
+        """
+        **Tách file output**: Mỗi chi nhánh / đơn vị khai thác 1 file trong thư mục con riêng.
+        Output không có cột được chọn (vd: TTKT không có chi_nhanh_HUB) vẫn ghi 1 file.
+        """
+    )
+    ui.synced_selectbox(
+        "Tách file theo",
+        [""] + PARTITION_COLUMNS,
+        ["pipeline_options", "partition_by"],
+        format_func=lambda column: column or "Không tách",
+    )
+    st.markdown(
+        """
+        **Checkpoint**: Lưu lại từng file đã đọc, dữ liệu đã chuẩn bị và từng output đã ghi.
+        Nếu lần chạy bị lỗi, chạy lại với cùng bộ file chỉ xử lý lại phần lỗi / còn thiếu.
+        Checkpoint được xóa khi chạy xong. Để trống folder để dùng thư mục mặc định.
+        """
+    )
+    ui.synced_radio(
+        "Checkpoint", ["False", "True"], ["pipeline_options", "checkpoint"], label_visibility="collapsed"
+    )
+    ui.synced_textbox("Folder checkpoint", ["pipeline_options", "checkpoint_folder"])
+    st.markdown(
+        """
+        **Profiling (debug)**: Lưu plan đã tối ưu và thời gian chạy từng node của mỗi output
+        (file _plan.txt, _profile.csv cạnh output). Chạy plan thêm 1 lần nên chậm hơn.
+        """
+    )
+    ui.synced_radio(
+        "Profiling", ["False", "True"], ["pipeline_options", "profile"], label_visibility="collapsed"
+    )
+    st.markdown(
+        """
+        **Chạy chung server**: Số lượt xử lý chạy cùng lúc trên server và trần RAM ước lượng
+        cho tất cả các lượt (để trống = không giới hạn). Lượt chạy vượt giới hạn sẽ xếp hàng chờ.
+        """
+    )
+    ui.synced_textbox("Số lượt chạy đồng thời", ["pipeline_options", "max_concurrent_runs"])
+    ui.synced_textbox("Trần RAM toàn server (MB)", ["pipeline_options", "memory_ceiling_mb"])
+    st.markdown(
+        """
+        **Khởi động nhanh**: Ở lần mở trang đầu tiên sau khi khởi động server, import pipeline
+        và đọc trước rule / file tham chiếu đang cấu hình ở nền, để lần chạy đầu tiên trong ngày
+        nhanh như các lần sau.
+        """
+    )
+    ui.synced_radio(
+        "Đọc trước ở lần mở trang đầu tiên", ["False", "True"], ["pipeline_options", "preload"], label_visibility="collapsed"
+    )
+    loaded = import_times()
+    if loaded:
+        st.caption(
+            "Thời gian import: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in loaded.items())
+        )
 
 
 with tab3:  # Chạy luồng xử lý
@@ -75,7 +176,7 @@ with tab3:  # Chạy luồng xử lý
         st.markdown("**1️⃣ Nhập file raw**")
         pipeline_select = ui.synced_radio(
             label="",
-            options=["Xuất sạch Kho vùng tỉnh (HUB)", "Xuất sạch TTKT"],
+            options=["Xuất sạch Kho vùng tỉnh (HUB)", "Xuất sạch TTKT", "Xuất sạch HUB + TTKT"],
             config_key=["pipeline_options", "pipeline_select"],
             label_visibility="collapsed",
         )
@@ -89,7 +190,7 @@ with tab3:  # Chạy luồng xử lý
     with col2:  # Tùy chọn luồng
         st.markdown("**2️⃣ Tùy chọn luồng**")
         try:
-            if pipeline_select == "Xuất sạch Kho vùng tỉnh (HUB)":
+            if pipeline_select in ("Xuất sạch Kho vùng tỉnh (HUB)", "Xuất sạch HUB + TTKT"):
                 rule_rd_select = ui.synced_selectbox(
                     label="Rule rải đích",
                     options=get_folder_child(CONFIG["xuat_sach_hub"]["rule_rd_folder"], "xlsx"), # pyright: ignore[reportAttributeAccessIssue]
@@ -100,8 +201,8 @@ with tab3:  # Chạy luồng xử lý
                     options=get_folder_child(CONFIG["xuat_sach_hub"]["rule_kn_folder"], "xlsx"), # pyright: ignore[reportAttributeAccessIssue]
                     config_key=["xuat_sach_hub", "rule_kn_file"],
                 )
-            else:
-                rule_kn_select = ui.synced_selectbox(
+            if pipeline_select in ("Xuất sạch TTKT", "Xuất sạch HUB + TTKT"):
+                rule_ttkt_select = ui.synced_selectbox(
                     label="Rule LOG / TTKT",
                     options=get_folder_child(CONFIG["xuat_sach_ttkt"]["rule_folder"], "xlsx"), # type: ignore
                     config_key=["xuat_sach_ttkt", "rule_file"],
@@ -110,40 +211,200 @@ with tab3:  # Chạy luồng xử lý
             st.error("Cần setup config hợp lệ.")
     with col3:
         st.markdown("**3️⃣ Chạy xử lý**")
-        if st.button("Bắt đầu xử lý", type="primary", disabled=st.session_state.processing):
-            # Check conditions
-            if False:
-                pass
-            else:
-                st.session_state.processing = True
-                # Get config (output, uploaded, ref files)
-
-                # Run pipeline
-                with st.spinner("Đang xử lý...", show_time=True):
+        running, waiting = SCHEDULER.status()
+        held_mb = SCHEDULER.held_bytes() // (1024 * 1024)
+        if running or waiting or held_mb:
+            st.caption(
+                f"Server: {running} lượt đang chạy, {waiting} lượt đang chờ, "
+                f"{held_mb} MB dữ liệu đang giữ trong các session"
+            )
+        run_clicked = st.button("Bắt đầu xử lý", type="primary", disabled=st.session_state.processing)
+
+        # Chỉ đổi file rule: áp lại rule trên dữ liệu đã chuẩn bị ở lần chạy trước
+        prepared = st.session_state.get("prepared_input")
+        reapply_clicked = st.button(
+            "Áp lại rule (không đọc lại file raw)",
+            disabled=st.session_state.processing or prepared is None,
+        )
+        reapply_export = st.checkbox("Ghi file output khi áp lại rule", value=False)
+        if prepared is not None:
+            st.caption("Dữ liệu đã chuẩn bị từ: " + ", ".join(prepared.source_files))
+
+        # Chạy thử trên 1 phần dữ liệu trước khi chạy toàn bộ
+        preview_rows = st.number_input("Số dòng xem trước / file", min_value=10, value=1000, step=100)
+        preview_sample = st.toggle("Lấy mẫu ngẫu nhiên", value=False)
+        preview_clicked = st.button(
+            "Xem trước", disabled=st.session_state.processing or not raw_input
+        )
+
+    if preview_clicked:
+        with st.spinner("Đang chạy thử...", show_time=True):
+            start_time = time.time()
+            try:
+                # Chỉ đọc phần đầu file nên không tính RAM, nhưng vẫn chờ lượt như lần chạy thật
+                with scheduler_slot(0):
+                    preview = pipeline_module().preview_pipeline(
+                        raw_input,
+                        CONFIG,
+                        SELECT_KEYS[pipeline_select],
+                        n_rows=int(preview_rows),
+                        sample=preview_sample,
+                    )
+                st.caption(
+                    f"Xem trước {preview['rows_in']} dòng raw trong {time.time() - start_time:.2f}s"
+                )
+                st.dataframe(preview["summary"], hide_index=True)
+
+                for name, df_out in preview["outputs"].items():
+                    with st.expander(f"Kết quả {name}", expanded=False):
+                        st.dataframe(df_out, hide_index=True)
+                    if preview["unmatched"][name].height > 0:
+                        st.warning(f"{name}: key không có trong rule")
+                        st.dataframe(preview["unmatched"][name], hide_index=True)
+            except Exception as e:
+                st.error(f"Error: {e}")
+                st.code(traceback.format_exc())
+
+    if run_clicked or reapply_clicked:
+        st.session_state.processing = True
+
+        # Run pipeline
+        with st.spinner("Đang xử lý...", show_time=True):
+            start_time = time.time()
+
+            try:
+                select = SELECT_KEYS[pipeline_select]
+                if reapply_clicked:
+                    estimate = prepared.df.estimated_size() * 2
+                else:
+                    estimate = pipeline_module().estimate_memory(raw_input, CONFIG)
+
+                # Hàng đợi chung cho mọi session trên server
+                with scheduler_slot(estimate):
                     start_time = time.time()
 
-                    try:
-                        if pipeline_select == "Xuất sạch Kho vùng tỉnh (HUB)":
-                            result = pipeline_xs_hub(raw_input, CONFIG)
-                        else:
-                            result = pipeline_xs_ttkt(raw_input, CONFIG)
-                        
-                        elapsed_time = time.time() - start_time
-
-                        # Display results
-                        if result:
-                            st.success("Hoàn thành")
-                        # Results summary
-                            col1, col2, col3 = st.columns(3)
-                            with col1:
-                                st.metric("Số dòng raw", result["rows_in"])
-                            with col2:
-                                st.metric("Số dòng xử lý", result["rows_out"])
-                            with col3:
-                                st.metric("Thời gian xử lý", f"{elapsed_time:.2f}s")
-                    
-                    except Exception as e:
-                        st.error(f"Error: {e}")
-                        st.code(traceback.format_exc())
-                    finally:
-                        st.session_state.processing = False
\ No newline at end of file
+                    pipeline = pipeline_module()
+                    if reapply_clicked:
+                        result = pipeline.evaluate_rules(
+                            prepared, pipeline.load_rules(CONFIG, select), CONFIG, export=reapply_export
+                        )
+                    else:
+                        pipeline_func = getattr(pipeline, PIPELINES[f"xuat_sach_{select}"]["func"])
+                        result = pipeline_func(raw_input, CONFIG)
+
+                elapsed_time = time.time() - start_time
+
+                # Giữ base đã chuẩn bị cho lần áp lại rule sau; lần chạy không trả về base
+                # (out-of-core) thì bỏ base cũ để không áp rule lên dữ liệu của bộ file khác
+                st.session_state.prepared_input = result.get("prepared")
+                if st.session_state.prepared_input is not None:
+                    # Base giữ trong session vẫn chiếm RAM: tính vào trần RAM tới khi bị thay / giải phóng
+                    SCHEDULER.hold(
+                        st.session_state.prepared_input,
+                        st.session_state.prepared_input.df.estimated_size(),
+                    )
+
+                # Display results
+                if result:
+                    st.success("Hoàn thành")
+                    for warning in result.get("warnings", []):
+                        st.warning(warning)
+                # Results summary
+                    col1, col2, col3 = st.columns(3)
+                    with col1:
+                        st.metric("Số dòng raw", result["rows_in"])
+                    with col2:
+                        st.metric("Số dòng xử lý", result["rows_out"])
+                    with col3:
+                        st.metric("Thời gian xử lý", f"{elapsed_time:.2f}s")
+
+                    if "summary" in result:
+                        st.dataframe(result["summary"], hide_index=True)
+
+                    for name, profile in result.get("profiles", {}).items():
+                        with st.expander(f"Profiling {name}", expanded=False):
+                            st.dataframe(profile["timings"], hide_index=True)
+                            st.code(profile["plan"])
+
+            except Exception as e:
+                st.error(f"Error: {e}")
+                st.code(traceback.format_exc())
+            finally:
+                st.session_state.processing = False
+
+
+with tab4:  # So sánh 2 lần chạy / 2 phiên bản rule
+    compare_mode = st.radio(
+        "Nguồn so sánh",
+        ["Hai file kết quả đã lưu", "Rule hiện tại với rule khác (dữ liệu lần chạy trước)"],
+        horizontal=True,
+    )
+    compare_ready = False
+
+    if compare_mode == "Hai file kết quả đã lưu":
+        col1, col2 = st.columns(2)
+        with col1:
+            old_file = st.file_uploader("Kết quả cũ", type=["csv"], key="compare_old")
+        with col2:
+            new_file = st.file_uploader("Kết quả mới", type=["csv"], key="compare_new")
+        compare_ready = old_file is not None and new_file is not None
+    else:
+        prepared = st.session_state.get("prepared_input")
+        if prepared is None:
+            st.info("Cần chạy xử lý 1 lần trước để có dữ liệu so sánh.")
+        else:
+            st.caption("Dữ liệu lần chạy trước từ: " + ", ".join(prepared.source_files))
+            select = SELECT_KEYS[pipeline_select]
+            compare_output = st.selectbox("Output", SELECT_OUTPUTS[select])
+            section, folder_key, file_key = RULE_LOCATIONS[compare_output]
+            try:
+                old_rule_file = st.selectbox(
+                    f"Rule so sánh (hiện tại: {CONFIG[section][file_key]})",
+                    get_folder_child(CONFIG[section][folder_key], "xlsx"),
+                )
+                compare_ready = old_rule_file is not None
+            except FileNotFoundError:
+                st.error("Cần setup config hợp lệ.")
+
+    if st.button("So sánh", disabled=not compare_ready):
+        with st.spinner("Đang so sánh...", show_time=True):
+            start_time = time.time()
+            try:
+                compare = compare_module()
+                if compare_mode == "Hai file kết quả đã lưu":
+                    estimate = compare.estimate_memory([old_file, new_file])
+                else:
+                    estimate = prepared.df.estimated_size() * 2
+
+                with scheduler_slot(estimate):
+                    start_time = time.time()
+                    if compare_mode == "Hai file kết quả đã lưu":
+                        comparison = compare.compare_results(
+                            compare.scan_result(old_file), compare.scan_result(new_file)
+                        )
+                    else:
+                        pipeline = pipeline_module()
+                        new_rules = pipeline.load_rules(CONFIG, select)
+                        old_rules = dict(new_rules)
+                        old_rules[compare_output] = pipeline.load_rule(CONFIG, compare_output, old_rule_file)
+
+                        base = prepared.df.lazy()
+                        comparison = compare.compare_results(
+                            pipeline.build_outputs(base, old_rules)[compare_output],
+                            pipeline.build_outputs(base, new_rules)[compare_output],
+                        )
+
+                st.metric("Số dòng thay đổi", comparison.changed.height)
+                st.caption(f"Thời gian so sánh: {time.time() - start_time:.2f}s")
+                st.markdown("**Ma trận Result_p (cũ → mới)**")
+                st.dataframe(comparison.transitions, hide_index=True)
+                st.markdown("**Chi tiết dòng thay đổi**")
+                st.dataframe(comparison.changed, hide_index=True)
+                if not comparison.duplicates.is_empty():
+                    st.warning(
+                        f"{comparison.duplicates.height} key bị trùng, chỉ so sánh dòng đầu tiên của mỗi key."
+                    )
+                    st.dataframe(comparison.duplicates, hide_index=True)
+            except Exception as e:
+                st.error(f"Error: {e}")
+                st.code(traceback.format_exc())
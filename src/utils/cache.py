@@ -0,0 +1,50 @@
+"""Process-wide cache of reference data shared read-only by all sessions."""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, Optional, TypeVar
+
+T = TypeVar("T")
+
+MAX_ENTRIES = 16  # Bỏ mục dùng lâu nhất khi vượt (rule cũ, file tham chiếu cũ, ...)
+
+_cache: OrderedDict[Hashable, tuple[Hashable, Any]] = OrderedDict()
+_lock = threading.Lock()
+
+
+def file_stamp(path: Optional[str]) -> Hashable:
+    if not path:
+        return None
+    return (os.path.abspath(path), os.path.getmtime(path), os.path.getsize(path))
+
+
+def load_shared(kind: str, paths: Iterable[Optional[str]], loader: Callable[[], T]) -> T:
+    """
+    Trả về kết quả loader() dùng chung giữa các session, đọc lại khi 1 trong các file đổi.
+    Kết quả (polars DataFrame, ...) chỉ được đọc, không sửa tại chỗ.
+    """
+    paths = tuple(paths)
+    key = (kind, tuple(os.path.abspath(p) if p else None for p in paths))
+    stamp = tuple(file_stamp(p) for p in paths)
+
+    with _lock:
+        cached = _cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            _cache.move_to_end(key)
+            return cached[1]
+
+    # Đọc ngoài lock để các file khác không phải chờ
+    value = loader()
+
+    with _lock:
+        _cache[key] = (stamp, value)
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_ENTRIES:
+            _cache.popitem(last=False)
+    return value
+
+
+def clear_shared() -> None:
+    with _lock:
+        _cache.clear()
@@ -35,7 +35,8 @@ def load_config() -> Dict[str, Any]:
     # Return default configuration
     return {
         "common": {
-            "thamchieu_noitinh": ""
+            "thamchieu_noitinh": "",
+            "hub_overrides": ""
         },
         "xuat_sach_hub": {
             "rule_rd_folder": "",
@@ -52,7 +53,16 @@ def load_config() -> Dict[str, Any]:
         },
         "pipeline_options": {
             "pipeline_select": "",
-            "fast_mode": "False"
+            "fast_mode": "False",
+            "out_of_core": "False",
+            "memory_cap_mb": "4096",
+            "max_concurrent_runs": "1",
+            "memory_ceiling_mb": "",
+            "partition_by": "",
+            "checkpoint": "False",
+            "checkpoint_folder": "",
+            "profile": "False",
+            "preload": "False"
         }
     }
 
@@ -0,0 +1,122 @@
+"""Process-wide admission control for pipeline runs shared by all Streamlit sessions."""
+
+import itertools
+import threading
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+
+class JobScheduler:
+    """
+    Hàng đợi FIFO giới hạn số lượt chạy đồng thời và tổng RAM ước lượng.
+    Job đứng đầu hàng đợi luôn được chạy nếu không còn job nào đang chạy,
+    kể cả khi ước lượng vượt trần RAM (tránh treo vĩnh viễn).
+    Dữ liệu session giữ lại giữa các lượt chạy (hold) cũng được tính vào trần RAM.
+    """
+
+    def __init__(self, max_concurrent: int = 1, memory_ceiling_bytes: int = 0):
+        self.max_concurrent = max_concurrent
+        self.memory_ceiling_bytes = memory_ceiling_bytes  # 0 = không giới hạn
+
+        self._cond = threading.Condition()
+        self._queue: deque[int] = deque()
+        self._running: dict[int, int] = {}  # job_id: RAM ước lượng
+        self._held: dict[int, int] = {}  # hold_id: RAM của dữ liệu đang giữ
+        self._ids = itertools.count(1)
+
+    def configure(self, max_concurrent: int, memory_ceiling_bytes: int) -> None:
+        with self._cond:
+            self.max_concurrent = max(1, max_concurrent)
+            self.memory_ceiling_bytes = max(0, memory_ceiling_bytes)
+            self._cond.notify_all()
+
+    def position(self, job_id: int) -> int:
+        """Vị trí trong hàng đợi (1 = tiếp theo), 0 nếu đang chạy / không có"""
+        with self._cond:
+            try:
+                return self._queue.index(job_id) + 1
+            except ValueError:
+                return 0
+
+    def status(self) -> tuple[int, int]:
+        """(số job đang chạy, số job đang chờ)"""
+        with self._cond:
+            return len(self._running), len(self._queue)
+
+    def held_bytes(self) -> int:
+        with self._cond:
+            return sum(self._held.values())
+
+    def hold(self, obj: object, nbytes: int) -> None:
+        """Tính RAM của obj (vd base đã chuẩn bị trong session) cho tới khi obj được giải phóng"""
+        with self._cond:
+            hold_id = next(self._ids)
+            self._held[hold_id] = nbytes
+        weakref.finalize(obj, self._release, hold_id)
+
+    def _release(self, hold_id: int) -> None:
+        with self._cond:
+            self._held.pop(hold_id, None)
+            self._cond.notify_all()
+
+    def _can_start(self, job_id: int, estimate_bytes: int) -> bool:
+        if self._queue[0] != job_id:
+            return False
+        if not self._running:
+            return True
+        if len(self._running) >= self.max_concurrent:
+            return False
+        if self.memory_ceiling_bytes <= 0:
+            return True
+        used = sum(self._running.values()) + sum(self._held.values())
+        return used + estimate_bytes <= self.memory_ceiling_bytes
+
+    @contextmanager
+    def slot(
+        self,
+        estimate_bytes: int = 0,
+        on_wait: Optional[Callable[[int], None]] = None,
+        poll_seconds: float = 1.0,
+    ) -> Iterator[int]:
+        """
+        Chờ tới lượt rồi giữ 1 slot chạy trong suốt khối with.
+        on_wait(position) được gọi định kỳ khi còn phải chờ (cập nhật UI).
+        """
+        with self._cond:
+            job_id = next(self._ids)
+            self._queue.append(job_id)
+
+        try:
+            with self._cond:
+                while not self._can_start(job_id, estimate_bytes):
+                    if on_wait is not None:
+                        position = self._queue.index(job_id) + 1
+                        self._cond.release()
+                        try:
+                            on_wait(position)
+                        finally:
+                            self._cond.acquire()
+                    self._cond.wait(timeout=poll_seconds)
+                self._queue.popleft()
+                self._running[job_id] = estimate_bytes
+                self._cond.notify_all()
+        except BaseException:
+            # Session bị dừng khi đang chờ: bỏ khỏi hàng đợi
+            with self._cond:
+                if job_id in self._queue:
+                    self._queue.remove(job_id)
+                self._cond.notify_all()
+            raise
+
+        try:
+            yield job_id
+        finally:
+            with self._cond:
+                self._running.pop(job_id, None)
+                self._cond.notify_all()
+
+
+# Dùng chung cho mọi session trong cùng process Streamlit
+SCHEDULER = JobScheduler()
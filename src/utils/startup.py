@@ -0,0 +1,77 @@
+"""Deferred imports of the heavy pipeline modules and background warm-up on the first page view."""
+
+import importlib
+import sys
+import threading
+import time
+from types import ModuleType
+from typing import Any, Dict, Optional
+
+PIPELINE_MODULE = "etl.pipeline_xuatsach"
+COMPARE_MODULE = "etl.compare"
+
+_import_times: Dict[str, float] = {}
+_lock = threading.Lock()
+_warmup_thread: Optional[threading.Thread] = None
+
+
+def timed_import(module_name: str) -> ModuleType:
+    """Import module khi cần, ghi lại thời gian import lần đầu (giây)"""
+    # Import nằm ngoài _lock: Python đã tự khóa theo từng module, trang khác không phải chờ
+    already_loaded = module_name in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    elapsed = time.perf_counter() - start
+
+    if not already_loaded:
+        with _lock:
+            _import_times.setdefault(module_name, elapsed)
+    return module
+
+
+def pipeline_module() -> ModuleType:
+    return timed_import(PIPELINE_MODULE)
+
+
+def compare_module() -> ModuleType:
+    return timed_import(COMPARE_MODULE)
+
+
+def import_times() -> Dict[str, float]:
+    with _lock:
+        return dict(_import_times)
+
+
+def _warm_up(config: Dict[str, Any]) -> None:
+    pipeline = pipeline_module()
+
+    # Đọc trước rule / tham chiếu vào cache dùng chung; config chưa hợp lệ thì bỏ qua
+    try:
+        pipeline.load_reference(config)
+    except Exception:
+        pass
+
+    for name in pipeline.RULE_LOCATIONS:
+        try:
+            pipeline.load_rule(config, name)
+        except Exception:
+            pass
+
+
+def start_warm_up(config: Dict[str, Any]) -> None:
+    """
+    Chạy warm-up 1 lần mỗi process, ở thread nền để không chặn trang đầu tiên.
+    Streamlit chỉ chạy app.py khi có session, nên warm-up bắt đầu ở lần mở trang đầu tiên
+    của process chứ không phải lúc khởi động server.
+    """
+    global _warmup_thread
+
+    # Đã chạy: không cần lấy lock ở mỗi lần render trang
+    if _warmup_thread is not None or config["pipeline_options"].get("preload") != "True":
+        return
+
+    with _lock:
+        if _warmup_thread is not None:
+            return
+        _warmup_thread = threading.Thread(target=_warm_up, args=(config,), daemon=True)
+        _warmup_thread.start()